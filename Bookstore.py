@@ -1,409 +1,3045 @@
 # Program for book keeping to create a database to store, update books, and search for books. 
 # This program displays results of authors when similar titles are present and gives suggestions if mispelt titles are given
+import time
+# Start up is timed from here, see main()
+STARTED = time.perf_counter()
 import sqlite3
+import contextlib
+import csv
+import functools
+import heapq
+import json
+import os
+import queue
+import re
+import sys
+import threading
 # This is for similar searches. You can use fuzzywuzzy but that requires to install libraries
 import difflib
+import math
+from array import array
+from collections import OrderedDict, namedtuple
+
+# Minimum score a title or author needs before it is offered as a "Did you mean" suggestion
+SUGGESTION_THRESHOLD = 0.75
+# Number of search results the menu shows at a time
+SEARCH_PAGE_SIZE = 20
+# Ways BookDatabase can shortlist the titles or authors to score: "difflib" from the in-memory FuzzyIndex (every
+# match is found), "fts" from the book_vocab_fts trigram index ranked by SQLite (the FTS_CANDIDATES best only)
+SEARCH_ENGINES = ("difflib", "fts")
+FTS_CANDIDATES = 500
+
+
+class FuzzyIndex:
+    """
+    In-memory index over the distinct values of one book column (title or author) used to shortlist
+    candidates before they are scored with difflib.
+    
+    difflib's ratio is 2*M/T where M is the number of matched characters and T the combined length
+    of both strings. The index uses three bounds that can never reject a string that would reach the cutoff:
+    - Length: M can be at most the shorter length, so only a band of lengths around the query can qualify.
+    - Shared bigrams: every matching block of L characters shares L-1 bigrams with the query, and the
+      number of blocks is limited by the unmatched characters, so a string needs at least 3*M - T - 1
+      shared bigrams. Trigrams would give a weaker bound that is useless at the default 0.75 threshold.
+    - Positions: the characters before a matching block are matched in both strings or unmatched, so a block
+      starts at most the query's unmatched characters earlier, or the string's later, than in the query.
+      Only bigrams within that distance of their place in the query are counted.
+    Strings whose length makes the bigram bound zero or less are taken straight from their length bucket.
+    
+    At thresholds as low as 0.75 these bounds let through a share of the catalogue (roughly a tenth of the
+    distinct titles of benchmark.py's synthetic catalogue), and finding them walks the postings of the
+    query's bigrams, so shortlisting still grows in proportion to the number of distinct values. It makes
+    searches a constant factor faster than scoring everything, it does not make them sub-linear.
+    """
+    def __init__(self):
+        # value -> set of book ids holding that value
+        self.ids = {}
+        # length -> set of values with that length
+        self.by_length = {}
+        # (bigram, length, position) -> set of values of that length with the bigram starting at that position
+        self.postings = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, value, book_id):
+        """
+        Register a book id under a value, indexing the value the first time it is seen.
+        """
+        book_ids = self.ids.get(value)
+        if book_ids is None:
+            book_ids = self.ids[value] = set()
+            length = len(value)
+            self.by_length.setdefault(length, set()).add(value)
+            for position in range(length - 1):
+                self.postings.setdefault((value[position:position + 2], length, position), set()).add(value)
+        book_ids.add(book_id)
+
+    def remove(self, value, book_id):
+        """
+        Remove a book id from a value, dropping the value from the index once no book uses it.
+        """
+        book_ids = self.ids.get(value)
+        if book_ids is None:
+            return
+        book_ids.discard(book_id)
+        if book_ids:
+            return
+        del self.ids[value]
+        length = len(value)
+        self.by_length[length].discard(value)
+        if not self.by_length[length]:
+            del self.by_length[length]
+        for position in range(length - 1):
+            key = (value[position:position + 2], length, position)
+            posting = self.postings[key]
+            posting.discard(value)
+            if not posting:
+                del self.postings[key]
+
+    def candidates(self, query, cutoff):
+        """
+        Shortlist the values that could score at least the cutoff against the query.
+        
+        Arguments:
+            query (string) already in the same case as the indexed values.
+            cutoff (float) 0-1 lowest score that is of interest.
+        
+        Returns a list of values, ordered by the first book id using them so ties are broken
+        the same way as a scan of the table.
+        """
+        query_length = len(query)
+        shortlisted = []
+        # length -> (fewest shared bigrams needed, furthest a bigram can be found before and after its place in the query)
+        needs_bigrams = {}
+        for length, values in self.by_length.items():
+            total = query_length + length
+            # Upper bound of the ratio from the lengths alone
+            if total and 2.0 * min(query_length, length) / total < cutoff:
+                continue
+            # Fewest matched characters and then fewest shared bigrams needed to reach the cutoff
+            min_matches = max(0, math.ceil(cutoff * total / 2 - 1e-9))
+            min_shared = 3 * min_matches - total - 1
+            if min_shared <= 0:
+                shortlisted.extend(values)
+            else:
+                needs_bigrams[length] = (min_shared, query_length - min_matches, length - min_matches)
+
+        if needs_bigrams:
+            # A bigram is counted once for each place in the query it could have come from, which can only
+            # overcount, so no string that could reach the cutoff is missed
+            shared = {}
+            postings = self.postings
+            for query_position in range(query_length - 1):
+                bigram = query[query_position:query_position + 2]
+                for length, (min_shared, before, after) in needs_bigrams.items():
+                    for position in range(max(0, query_position - before), min(length - 2, query_position + after) + 1):
+                        posting = postings.get((bigram, length, position))
+                        if posting:
+                            for value in posting:
+                                shared[value] = shared.get(value, 0) + 1
+            for value, count in shared.items():
+                if count >= needs_bigrams[len(value)][0]:
+                    shortlisted.append(value)
+
+        return sorted(shortlisted, key=lambda value: min(self.ids[value]))
+
+    def book_ids(self, value):
+        """
+        Return the set of book ids stored under a value.
+        """
+        return self.ids.get(value, set())
+
+    def memory_usage(self):
+        """
+        Measure the memory held by the index in bytes: the values, the book ids under them, the length
+        buckets and the bigram postings. Ints small enough for Python to share are counted every time.
+        """
+        total = sys.getsizeof(self) + sys.getsizeof(self.ids) + sys.getsizeof(self.by_length) + sys.getsizeof(self.postings)
+        for value, book_ids in self.ids.items():
+            total += sys.getsizeof(value) + sys.getsizeof(book_ids) + sum(sys.getsizeof(book_id) for book_id in book_ids)
+        total += sum(sys.getsizeof(values) for values in self.by_length.values())
+        for key, values in self.postings.items():
+            total += sys.getsizeof(key) + sys.getsizeof(key[0]) + sys.getsizeof(values)
+        return total
+
+
+class AuthorIndex(FuzzyIndex):
+    """
+    FuzzyIndex over normalized author keys (see author_key), so "J.R.R. TOLKIEN" and "JRR TOLKIEN" are one
+    value: scored once and mapped to the books of both spellings. Also keeps:
+    - the Soundex key of every author key, for authors that sound like the query but are spelt differently
+    - the author and title of every book, so an author's books can be listed alphabetically without fetching them.
+      Given a CatalogueSnapshot they are read from its columns instead of being kept twice.
+    """
+    def __init__(self, snapshot=None):
+        super().__init__()
+        # phonetic key -> set of author keys
+        self.phonetic = {}
+        self.snapshot = snapshot
+        # book id -> (author, title), only without a snapshot
+        self.listing = {} if snapshot is None else None
+
+    def add_author(self, author, title, book_id):
+        """
+        Register a book under its author's key.
+        """
+        key = author_key(author)
+        if key not in self.ids:
+            self.phonetic.setdefault(phonetic_key(key), set()).add(key)
+        self.add(key, book_id)
+        if self.listing is not None:
+            self.listing[book_id] = (author, title)
+
+    def remove_author(self, author, book_id):
+        """
+        Remove a book from its author's key, dropping the key once no book uses it.
+        """
+        key = author_key(author)
+        self.remove(key, book_id)
+        if self.listing is not None:
+            self.listing.pop(book_id, None)
+        if key not in self.ids:
+            sounds = self.phonetic.get(phonetic_key(key))
+            if sounds is not None:
+                sounds.discard(key)
+                if not sounds:
+                    del self.phonetic[phonetic_key(key)]
+
+    def sounds_like(self, key):
+        """
+        Return the set of author keys with the same phonetic key as this author key.
+        """
+        return self.phonetic.get(phonetic_key(key), set())
+
+    def display(self, key):
+        """
+        Return the author as written on the first book with this key, the key itself if there is none.
+        """
+        book_ids = self.ids.get(key)
+        return self.author_and_title(min(book_ids))[0] if book_ids else key
+
+    def author_and_title(self, book_id):
+        """
+        Return the (author, title) of an indexed book, from the snapshot if the index has one.
+        """
+        if self.listing is not None:
+            return self.listing[book_id]
+        row = self.snapshot.positions[book_id]
+        return self.snapshot.authors[row], self.snapshot.titles[row]
+
+    def memory_usage(self):
+        """
+        Measure the memory held by the index in bytes, as FuzzyIndex.memory_usage plus the phonetic keys and,
+        without a snapshot, the listing of every book's author and title.
+        """
+        total = super().memory_usage() + sys.getsizeof(self.phonetic)
+        for sound, keys in self.phonetic.items():
+            total += sys.getsizeof(sound) + sys.getsizeof(keys)
+        if self.listing is not None:
+            total += sys.getsizeof(self.listing)
+            for book_id, (author, title) in self.listing.items():
+                total += sys.getsizeof(book_id) + sys.getsizeof((author, title)) + sys.getsizeof(author) + sys.getsizeof(title)
+        return total
+
+
+class BookstoreError(Exception):
+    """
+    Base class for every error raised by the BookDatabase API.
+    """
+
+
+class DatabaseError(BookstoreError):
+    """
+    Raised when SQLite reports an error. The original sqlite3 error is kept as the cause.
+    """
+
+
+class BookNotFoundError(BookstoreError):
+    """
+    Raised when no book matches the given ID or title and author.
+    """
+
+
+class InvalidBookError(BookstoreError):
+    """
+    Raised when a title, author or quantity given to the API is not valid.
+    """
+
+
+class InvalidSettingError(BookstoreError):
+    """
+    Raised when an unknown connection profile or setting is given to BookDatabase, or a page of search results
+    that cannot be given (such as a limit below 1).
+    """
+
+
+class StoreNotFoundError(BookstoreError):
+    """
+    Raised when ShardedCatalogue is given the name of a store it does not have.
+    """
+
+
+# Records returned by the BookDatabase API
+Book = namedtuple("Book", ["id", "title", "author", "qty"])
+# matches is a list of (Book, score) pairs with the highest score first, suggestion is a string or None
+SearchResult = namedtuple("SearchResult", ["matches", "suggestion"])
+# created is True when a new row was inserted and False when an existing row's quantity was increased
+AddResult = namedtuple("AddResult", ["book", "created"])
+# book holds the new quantity, previous_qty the quantity before the update and deleted is True if a quantity of 0 removed it
+UpdateResult = namedtuple("UpdateResult", ["book", "previous_qty", "deleted"])
+# One page of search results: matches and suggestion as in SearchResult, next_cursor is passed as after to
+# search_page for the following page and is None on the last one
+SearchPage = namedtuple("SearchPage", ["matches", "suggestion", "next_cursor"])
+# matches is a list of (position, score) for the candidates reaching the threshold, in candidate order.
+# best is the (position, score) of the first candidate with the highest score, if it reaches SUGGESTION_THRESHOLD,
+# otherwise None. It is only worked out while there are no matches, since a suggestion is only made without them.
+# BookDatabase.with_sound_alikes may set it to an author that sounds like the query, whatever its score.
+ScoreResult = namedtuple("ScoreResult", ["matches", "best"])
+# Search cache statistics. expired and stale entries (older than the ttl or than the latest write) also count as misses
+CacheStats = namedtuple("CacheStats", ["hits", "misses", "evictions", "expired", "stale", "size", "hit_rate"])
+# Memory measured for a CatalogueSnapshot, in bytes
+SnapshotMemory = namedtuple("SnapshotMemory", ["books", "distinct_strings", "total_bytes", "bytes_per_book"])
+# Memory measured for the title and author fuzzy indexes, in bytes
+IndexMemory = namedtuple("IndexMemory", ["books", "title_bytes", "author_bytes", "total_bytes", "bytes_per_book"])
+# rows read from the import, books inserted and existing books whose quantity was increased
+ImportResult = namedtuple("ImportResult", ["rows", "inserted", "merged", "seconds"])
+# Calls of one operation or phase timed by Instrumentation, with their total and longest time in seconds
+TimerStats = namedtuple("TimerStats", ["calls", "seconds", "max_seconds"])
+# timers maps operation and phase names to TimerStats. rows_scanned counts rows read from SQLite or the snapshot,
+# rows_scored titles or authors given to the scorer, sql_statements statements run and progress_calls
+# calls of the SQLite progress handler (a measure of the work SQLite did)
+InstrumentationStats = namedtuple("InstrumentationStats", ["timers", "rows_scanned", "rows_scored", "sql_statements", "progress_calls"])
+# A book found by a ShardedCatalogue search: the name of the store it is in, the Book (its ID is only unique
+# within that store) and its score
+StoreMatch = namedtuple("StoreMatch", ["store", "book", "score"])
+# Stock of one title and author across the stores of a ShardedCatalogue: qty is the total and stores maps
+# each store that has it to its quantity there
+StockLevel = namedtuple("StockLevel", ["title", "author", "qty", "stores"])
+
+# Number of values in each kind of BookDatabase.apply_operations operation, counting its name
+OPERATION_SIZES = {"add": 4, "adjust": 3, "update": 4, "delete": 2}
+
+# The books requested in the task, inserted on start up
+PRE_GENERATED_BOOKS = [
+    (3001, "A Tale of Two Cities", "Charles Dickens", 30),
+    (3002, "Harry Potter and the Philosopher's Stone", "J.K. Rowling", 40),
+    (3003, "The Lion, the Witch and the Wardrobe", "C.S. Lewis", 25),
+    (3004, "The Lord of the Rings", "J.R.R. Tolkien", 37),
+    (3005, "Alice in Wonderland", "Lewis Carroll", 12),
+    (3006, "To Kill a Mockingbird", "Harper Lee", 55),
+    (3007, "1984", "George Orwell", 33),
+    (3008, "The Great Gatsby", "F. Scott Fitzgerald", 1),
+    (3009, "War and Peace", "Leo Tolstoy", 23),
+    (3010, "Beowolf", "J.R.R. Tolkien", 6),
+    (3011, "The Beautiful and Damned", "F. Scott Fitzgerald", 8),
+    (3012, "A Tale of Two Cities", "Agatha Christie", 1056),
+]
+
+
+def check_quantity(quantity):
+    """
+    Make sure a quantity is a whole number that is not negative.
+    
+    Raises InvalidBookError otherwise.
+    """
+    if isinstance(quantity, bool) or not isinstance(quantity, int) or quantity < 0:
+        raise InvalidBookError(f'Quantity must be a whole number of 0 or more, got {quantity!r}.')
+
+
+def check_book_id(book_id):
+    """
+    Make sure a book ID is a whole number.
+    
+    Raises InvalidBookError otherwise.
+    """
+    if isinstance(book_id, bool) or not isinstance(book_id, int):
+        raise InvalidBookError(f'A book ID must be a whole number, got {book_id!r}.')
+
+
+def author_key(author):
+    """
+    Normalize an author for matching: upper case, punctuation dropped and runs of initials joined,
+    so "J.R.R. Tolkien", "J. R. R. TOLKIEN" and "JRR Tolkien" all give "JRR TOLKIEN".
+    """
+    words = re.findall(r"\w+", re.sub(r"[.']", "", author.upper()))
+    key = []
+    initials = ""
+    for word in words:
+        if len(word) == 1:
+            initials += word
+            continue
+        if initials:
+            key.append(initials)
+            initials = ""
+        key.append(word)
+    if initials:
+        key.append(initials)
+    return " ".join(key)
+
+
+# American Soundex digits, letters not listed (vowels, H, W and Y) have none
+SOUNDEX_CODES = {letter: digit for digit, letters in enumerate(("BFPV", "CGJKQSXZ", "DT", "L", "MN", "R"), 1)
+                 for letter in letters}
+
+
+def soundex(word):
+    """
+    American Soundex code of a word, the same for words that sound alike: ROBERT and RUPERT are both R163.
+    Words without letters (such as numbers) are returned as they are.
+    """
+    letters = "".join(letter for letter in word.upper() if "A" <= letter <= "Z")
+    if not letters:
+        return word
+    code = letters[0]
+    last = SOUNDEX_CODES.get(letters[0])
+    for letter in letters[1:]:
+        digit = SOUNDEX_CODES.get(letter)
+        if digit and digit != last:
+            code += str(digit)
+        # A vowel between two letters with the same digit means both are coded, H and W do not
+        if letter not in "HW":
+            last = digit
+    return (code + "000")[:4]
+
+
+def phonetic_key(key):
+    """
+    Soundex code of every word of an author key, "JRR TOLKIEN" and "JRR TOLKEIN" are both "J600 T425".
+    """
+    return " ".join(soundex(word) for word in key.split())
+
+
+def normalize_book(title, author):
+    """
+    Convert a title and author to upper case, the format used in the database.
+    
+    Raises InvalidBookError if either is not a string or is empty.
+    """
+    if not isinstance(title, str) or not isinstance(author, str):
+        raise InvalidBookError(f'A title and author must be text, got {title!r} and {author!r}.')
+    title = title.strip().upper()
+    author = author.strip().upper()
+    if not title or not author:
+        raise InvalidBookError("A book needs both a title and an author.")
+    return title, author
+
+
+def score_chunk(query, values, threshold, start=0):
+    """
+    Score a list of titles or authors against the query in one pass, collecting both the matches and the best
+    suggestion so nothing has to be scored twice. This is a plain function (rather than a method) so it can be
+    sent to another process.
+    
+    difflib's ratio() is costly, so each candidate goes through cheaper upper bounds of it first and is only
+    scored when it could still match or become the suggestion:
+    - the lengths alone (what real_quick_ratio() works out)
+    - the characters in common whatever their order (quick_ratio())
+    The scores that are worked out are exactly the ones ratio() always gave.
+    
+    Arguments:
+        query (string) in upper case.
+        values (list) of titles or authors.
+        threshold (float) 0-1 lowest score for a match.
+        start (int) is the position of values[0] in the full candidate list, added to the positions returned.
+    
+    Returns a ScoreResult.
+    """
+    matches = []
+    best = None
+    # Lowest score a candidate needs to be of use: a match, or a suggestion beating the best one so far
+    floor = min(threshold, max(SUGGESTION_THRESHOLD, math.nextafter(0, 1)))
+    # The bounds come from a matcher holding the query as its second sequence, so the query's
+    # character counts are only worked out once
+    bounds = difflib.SequenceMatcher(None)
+    bounds.set_seq2(query)
+    # The score itself keeps the query as the first sequence, ratio() is not symmetric
+    scorer = difflib.SequenceMatcher(None)
+    scorer.set_seq1(query)
+    query_length = len(query)
+    for position, value in enumerate(values, start):
+        total = query_length + len(value)
+        if total and 2.0 * min(query_length, len(value)) / total < floor:
+            continue
+        bounds.set_seq1(value)
+        if bounds.quick_ratio() < floor:
+            continue
+        # Using Levenshtein Distance to calculate a matching score
+        scorer.set_seq2(value)
+        score = scorer.ratio()
+        if score >= threshold:
+            matches.append((position, score))
+            # No suggestion is made once something matches, so only matches are of use from now on
+            floor = threshold
+        elif not matches and score >= floor:
+            # Keep the first of the highest scores, like a scan of the table would,
+            # so from now on a suggestion has to beat it
+            best = (position, score)
+            floor = min(threshold, math.nextafter(score, 2))
+    return ScoreResult(matches, best)
+
+
+def merge_scores(results):
+    """
+    Combine the ScoreResults of consecutive chunks (in order) into the result for the whole list.
+    """
+    matches = []
+    best = None
+    for result in results:
+        matches.extend(result.matches)
+        if result.best and (best is None or result.best[1] > best[1]):
+            best = result.best
+    return ScoreResult(matches, best)
+
+
+class FuzzyScorer:
+    """
+    Scores candidate titles or authors, serially for small lists and split into chunks across a process pool
+    for large ones (difflib holds the GIL, so threads would not run it in parallel).
+    The process pool is only started the first time it is needed.
+    """
+    def __init__(self, processes=None, parallel_from=None, chunks_per_process=4):
+        """
+        Arguments:
+            processes (int) in the pool, by default one per CPU.
+            parallel_from (int) is the fewest candidates worth sending to the pool, below that the cost of
+            sending them to other processes is more than the time saved. By default 20000, or never
+            when there is only one process.
+            chunks_per_process (int) splits the work finer than one chunk per process so the chunks even out.
+        """
+        self.processes = processes or os.cpu_count() or 1
+        if parallel_from is None:
+            parallel_from = 20000 if self.processes > 1 else math.inf
+        self.parallel_from = parallel_from
+        self.chunks_per_process = chunks_per_process
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def is_parallel(self, count):
+        """
+        Return True if a list of count candidates would be scored on the process pool.
+        """
+        return count >= self.parallel_from
+
+    def submit(self, query, values, threshold):
+        """
+        Start scoring the values on the process pool in chunks.
+        
+        Returns a list of concurrent.futures.Future, one per chunk in order, to be combined with merge_scores.
+        """
+        chunk_size = max(1, -(-len(values) // (self.processes * self.chunks_per_process)))
+        # Submitted while holding the lock so close() on another thread cannot shut the pool down in between
+        with self.lock:
+            if self.executor is None:
+                # Imported here rather than at the top, it takes longer than the rest of the program takes to start
+                import concurrent.futures
+                self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.processes)
+            return [self.executor.submit(score_chunk, query, values[start:start + chunk_size], threshold, start)
+                    for start in range(0, len(values), chunk_size)]
+
+    def score(self, query, values, threshold):
+        """
+        Score the values against the query, in parallel if there are enough of them.
+        
+        Returns a ScoreResult.
+        """
+        if not self.is_parallel(len(values)):
+            return score_chunk(query, values, threshold)
+        return merge_scores(future.result() for future in self.submit(query, values, threshold))
+
+    def close(self):
+        """
+        Shut down the process pool if it was started.
+        """
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+
+class SearchCache:
+    """
+    Least recently used cache of SearchResults, with an optional time to live.
+    
+    Entries are keyed on (upper case query, search_by_title, threshold) and stored with the catalogue generation
+    they were worked out at. BookDatabase moves its generation on with every write, which makes every older entry
+    stale on its next lookup, so a cached search never returns books or quantities that have since changed.
+    It also does so when it finds writes by other connections or programs (see BookDatabase.check_other_writes).
+    """
+    def __init__(self, max_entries=1024, ttl=None):
+        """
+        Arguments:
+            max_entries (int) kept before the least recently used entry is evicted.
+            ttl (float) seconds an entry can be used for, None to keep entries until they are stale or evicted.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> (generation, time stored, SearchResult), least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expired = self.stale = 0
+
+    def get(self, key, generation):
+        """
+        Return the cached SearchResult for key if it was worked out at this generation and has not expired, else None.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            stored_generation, stored_at, result = entry
+            if stored_generation != generation:
+                self.stale += 1
+            elif self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                self.expired += 1
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                # A fresh list so callers can't change the cached one
+                return result._replace(matches=list(result.matches))
+            del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, generation, result):
+        """
+        Store a SearchResult (or SearchPage) worked out at the given generation, evicting the least recently used
+        entries if full.
+        """
+        with self.lock:
+            self.entries[key] = (generation, time.monotonic(), result._replace(matches=list(result.matches)))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Remove every entry, the statistics are kept.
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        Return a CacheStats snapshot of the hit, miss and eviction counts.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return CacheStats(self.hits, self.misses, self.evictions, self.expired, self.stale, len(self.entries),
+                              self.hits / lookups if lookups else 0.0)
+
+
+class Instrumentation:
+    """
+    Timers and counters for BookDatabase operations, for finding out where the time goes.
+    
+    Every public BookDatabase method is timed under its own name and searches also by phase: "search.cache",
+    "search.candidates", "search.scoring", "search.fetch" and, in the menu, "search.output". SQL statements are
+    counted with a trace callback on every connection. A BookDatabase without instrumentation skips all of this,
+    its only cost is a check for None on each call.
+    """
+    def __init__(self, hook=None, sql_trace=None, progress_every=None):
+        """
+        Arguments:
+            hook (callable) called with the name and seconds taken every time an operation or phase finishes.
+            sql_trace (callable) called with the text of every SQL statement run.
+            progress_every (int) SQLite virtual machine instructions between calls of the progress handler,
+            which are counted. None leaves the progress handler off, it slows every query down a little.
+        """
+        self.hook = hook
+        self.sql_trace = sql_trace
+        self.progress_every = progress_every
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Set every timer and counter back to zero.
+        """
+        with self.lock:
+            # name -> [calls, total seconds, longest seconds]
+            self.timers = {}
+            self.rows_scanned = self.rows_scored = self.sql_statements = self.progress_calls = 0
+
+    def attach(self, conn):
+        """
+        Install the statement counter, and the progress handler if asked for, on an SQLite connection.
+        """
+        conn.set_trace_callback(self.traced)
+        if self.progress_every:
+            conn.set_progress_handler(self.progressed, self.progress_every)
+
+    def traced(self, statement):
+        with self.lock:
+            self.sql_statements += 1
+        if self.sql_trace is not None:
+            self.sql_trace(statement)
+
+    def progressed(self):
+        with self.lock:
+            self.progress_calls += 1
+        # Returning anything but 0 would interrupt the query
+        return 0
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """
+        Time the length of a with block under name.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def record(self, name, seconds):
+        """
+        Add one call taking seconds to the timer called name and pass it on to the hook.
+        """
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+        if self.hook is not None:
+            self.hook(name, seconds)
+
+    def count(self, rows_scanned=0, rows_scored=0):
+        """
+        Add to the row counters.
+        """
+        with self.lock:
+            self.rows_scanned += rows_scanned
+            self.rows_scored += rows_scored
+
+    def stats(self):
+        """
+        Return an InstrumentationStats snapshot of the timers and counters.
+        """
+        with self.lock:
+            timers = {name: TimerStats(*timer) for name, timer in self.timers.items()}
+            return InstrumentationStats(timers, self.rows_scanned, self.rows_scored, self.sql_statements, self.progress_calls)
+
+
+# Stands in for an Instrumentation timer when there is no instrumentation, it can be entered any number of times
+NOT_TIMED = contextlib.nullcontext()
+
+
+def instrumented(method):
+    """
+    Decorator timing every call of a BookDatabase method under its name, when the database has instrumentation.
+    Calls made by other methods are timed as well, so delete_book also counts as a get_book or find_book.
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def timed_method(self, *args, **kwargs):
+        if self.instrumentation is None:
+            return method(self, *args, **kwargs)
+        with self.instrumentation.timer(name):
+            return method(self, *args, **kwargs)
+    return timed_method
+
+
+class CatalogueSnapshot:
+    """
+    Compact in-memory copy of the book table for read heavy use, so searches never go back to SQLite.
+    
+    Rows are held column by column: IDs and quantities in array buffers (8 bytes a book each) and titles and
+    authors in lists pointing at one shared copy of each distinct string, so an author with a hundred books
+    is stored once. Deleting a book moves the last row into its place to keep the columns packed.
+    """
+    __slots__ = ("ids", "quantities", "titles", "authors", "positions", "strings")
+
+    def __init__(self):
+        self.ids = array("q")
+        self.quantities = array("q")
+        self.titles = []
+        self.authors = []
+        # book id -> row number
+        self.positions = {}
+        # distinct titles and authors, each string mapped to itself so every row shares the one copy
+        self.strings = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def shared(self, text):
+        """
+        Return the one stored copy of a title or author.
+        """
+        return self.strings.setdefault(text, text)
+
+    def add(self, book_id, title, author, qty):
+        """
+        Add a book, or replace it if the ID is already there.
+        """
+        if book_id in self.positions:
+            self.remove(book_id)
+        self.positions[book_id] = len(self.ids)
+        self.ids.append(book_id)
+        self.quantities.append(qty)
+        self.titles.append(self.shared(title))
+        self.authors.append(self.shared(author))
+
+    def set_quantity(self, book_id, qty):
+        """
+        Change the quantity of a book that is in the snapshot.
+        """
+        self.quantities[self.positions[book_id]] = qty
+
+    def remove(self, book_id):
+        """
+        Remove a book (if it is there). Distinct strings are kept, the same title or author usually comes back.
+        """
+        row = self.positions.pop(book_id, None)
+        if row is None:
+            return
+        last = len(self.ids) - 1
+        if row != last:
+            # Move the last row into the gap
+            self.ids[row] = self.ids[last]
+            self.quantities[row] = self.quantities[last]
+            self.titles[row] = self.titles[last]
+            self.authors[row] = self.authors[last]
+            self.positions[self.ids[row]] = row
+        self.ids.pop()
+        self.quantities.pop()
+        self.titles.pop()
+        self.authors.pop()
+
+    def get(self, book_id):
+        """
+        Return the Book with this ID or None.
+        """
+        row = self.positions.get(book_id)
+        if row is None:
+            return None
+        return Book(book_id, self.titles[row], self.authors[row], self.quantities[row])
+
+    def rows(self):
+        """
+        Yield (id, title, author) for every book, without making Book records.
+        """
+        return zip(self.ids, self.titles, self.authors)
+
+    def memory_usage(self):
+        """
+        Measure the memory held by the snapshot (the ID lookup, columns and distinct strings).
+        
+        Returns a SnapshotMemory.
+        """
+        total = sys.getsizeof(self)
+        for column in (self.ids, self.quantities):
+            total += sys.getsizeof(column)
+        total += sys.getsizeof(self.titles) + sys.getsizeof(self.authors)
+        # The dictionary keys are the only int objects the snapshot keeps, the arrays hold raw numbers
+        total += sys.getsizeof(self.positions) + sum(sys.getsizeof(book_id) for book_id in self.positions)
+        total += sys.getsizeof(self.strings) + sum(sys.getsizeof(text) for text in self.strings)
+        books = len(self.ids)
+        return SnapshotMemory(books, len(self.strings), total, total / books if books else 0.0)
+
+
+def book_file_format(path, file_format=None):
+    """
+    Work out whether a file is CSV or JSONL from the format given or from its extension.
+    
+    Raises InvalidBookError for anything else.
+    """
+    file_format = (file_format or os.path.splitext(path)[1].lstrip(".")).lower()
+    if file_format == "json":
+        file_format = "jsonl"
+    if file_format not in ("csv", "jsonl"):
+        raise InvalidBookError(f'Unsupported file format "{file_format}", use csv or jsonl.')
+    return file_format
+
+
+def read_books(path, file_format=None):
+    """
+    Stream (title, author, qty) rows from a CSV file with a header row or from a JSONL file
+    with one object per line. The columns/keys used are title, author and qty (qty defaults to 1),
+    anything else (such as id) is ignored. Rows are yielded one at a time so files of any size can be read.
+    
+    Raises InvalidBookError with the line number for a row that cannot be read.
+    """
+    file_format = book_file_format(path, file_format)
+    with open(path, newline="", encoding="utf-8") as file:
+        if file_format == "csv":
+            records = enumerate(csv.DictReader(file), start=2)
+        else:
+            records = ((line_number, line) for line_number, line in enumerate(file, start=1) if line.strip())
+        for line_number, record in records:
+            try:
+                if file_format == "jsonl":
+                    record = json.loads(record)
+                title, author, qty = record["title"], record["author"], record.get("qty")
+                if not isinstance(title, str) or not isinstance(author, str):
+                    raise ValueError("title and author must be text")
+                if qty in (None, ""):
+                    qty = 1
+                elif isinstance(qty, str):
+                    # From CSV, int() refuses anything but a whole number such as "2.7"
+                    qty = int(qty)
+                elif isinstance(qty, bool) or not isinstance(qty, int):
+                    # From JSON, where int() would cut 2.7 down to 2 and turn true into 1
+                    raise ValueError(f"qty must be a whole number, got {qty!r}")
+                yield title, author, qty
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                raise InvalidBookError(f'{path} line {line_number}: could not read book ({e!r}).') from e
+
+
+def write_books(path, books, file_format=None):
+    """
+    Write Book records to a CSV or JSONL file as they are produced by the iterable.
+    
+    Returns the number of books written.
+    """
+    file_format = book_file_format(path, file_format)
+    written = 0
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        if file_format == "csv":
+            writer = csv.writer(file)
+            writer.writerow(Book._fields)
+            for book in books:
+                writer.writerow(book)
+                written += 1
+        else:
+            for book in books:
+                file.write(json.dumps(book._asdict()) + "\n")
+                written += 1
+    return written
+
+
+def migrate_unique_title_author(cursor):
+    """
+    Schema version 1. Normalize existing titles and authors to trimmed upper case (the format the API writes),
+    merge duplicate books by adding their quantities into the lowest ID, then add a unique index on
+    (title, author) so exact lookups use the index and duplicates can no longer be inserted.
+    An author index is added for author lookups.
+    """
+    cursor.execute('''
+        UPDATE book SET title = normalize_text(title), author = normalize_text(author)
+        WHERE title IS NOT normalize_text(title) OR author IS NOT normalize_text(author)
+    ''')
+    # Also created by earlier bulk imports, it speeds up merging and is replaced by the unique index below
+    cursor.execute("CREATE INDEX IF NOT EXISTS book_title_author_idx ON book (title, author)")
+    cursor.execute('''
+        UPDATE book SET qty = (SELECT SUM(duplicate.qty) FROM book AS duplicate
+                               WHERE duplicate.title = book.title AND duplicate.author = book.author)
+        WHERE id IN (SELECT MIN(id) FROM book GROUP BY title, author HAVING COUNT(*) > 1)
+    ''')
+    cursor.execute("DELETE FROM book WHERE id NOT IN (SELECT MIN(id) FROM book GROUP BY title, author)")
+    cursor.execute("DROP INDEX book_title_author_idx")
+    cursor.execute("CREATE UNIQUE INDEX book_title_author_uq ON book (title, author)")
+    cursor.execute("CREATE INDEX book_author_idx ON book (author)")
+
+
+def create_search_vocabulary(cursor):
+    """
+    Add book_vocab, every distinct title and author with the number of books that have it, kept up to date by
+    triggers on book, and book_vocab_fts, an FTS5 trigram index of it for the "fts" search engine.
+    
+    Raises InvalidSettingError if this SQLite has no FTS5 or trigram tokenizer (before 3.34).
+    """
+    try:
+        # Contentless, the terms are read from book_vocab. Titles and authors go in their own columns so
+        # a search only matches its own kind
+        cursor.execute("CREATE VIRTUAL TABLE book_vocab_fts USING fts5 (title, author, content='', tokenize='trigram')")
+    except sqlite3.OperationalError as e:
+        raise InvalidSettingError('The "fts" search engine needs SQLite 3.34 or later built with FTS5.') from e
+    cursor.execute('''
+        CREATE TABLE book_vocab (
+            id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            term TEXT NOT NULL,
+            books INTEGER NOT NULL,
+            UNIQUE (kind, term)
+        )
+    ''')
+    for kind in ("title", "author"):
+        cursor.execute(f"INSERT INTO book_vocab (kind, term, books) SELECT '{kind}', {kind}, COUNT(*) FROM book GROUP BY {kind}")
+    # Count a title and author in, or out, of the vocabulary
+    count_in = '''
+        INSERT INTO book_vocab (kind, term, books) VALUES ('title', new.title, 1), ('author', new.author, 1)
+        ON CONFLICT (kind, term) DO UPDATE SET books = books + 1;
+    '''
+    count_out = '''
+        UPDATE book_vocab SET books = books - 1
+        WHERE (kind = 'title' AND term = old.title) OR (kind = 'author' AND term = old.author);
+        DELETE FROM book_vocab WHERE books = 0 AND ((kind = 'title' AND term = old.title) OR (kind = 'author' AND term = old.author));
+    '''
+    cursor.execute(f"CREATE TRIGGER book_vocab_insert AFTER INSERT ON book BEGIN {count_in} END")
+    cursor.execute(f"CREATE TRIGGER book_vocab_delete AFTER DELETE ON book BEGIN {count_out} END")
+    cursor.execute(f"CREATE TRIGGER book_vocab_update AFTER UPDATE OF title, author ON book BEGIN {count_out} {count_in} END")
+    columns = "CASE WHEN {0}.kind = 'title' THEN {0}.term END, CASE WHEN {0}.kind = 'author' THEN {0}.term END"
+    cursor.execute(f"INSERT INTO book_vocab_fts (rowid, title, author) SELECT id, {columns.format('book_vocab')} FROM book_vocab")
+    cursor.execute(f'''
+        CREATE TRIGGER book_vocab_fts_insert AFTER INSERT ON book_vocab BEGIN
+            INSERT INTO book_vocab_fts (rowid, title, author) VALUES (new.id, {columns.format('new')});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER book_vocab_fts_delete AFTER DELETE ON book_vocab BEGIN
+            INSERT INTO book_vocab_fts (book_vocab_fts, rowid, title, author) VALUES ('delete', old.id, {columns.format('old')});
+        END
+    ''')
+
+
+def migrate_metadata(cursor):
+    """
+    Schema version 2. Add bookstore_meta, name and value pairs about the database itself, starting with 'seeded'
+    to record that the pre-generated books have been added. A database that already has any of their IDs had them
+    added before, as populate_table used to refuse to add them again.
+    """
+    cursor.execute("CREATE TABLE bookstore_meta (name TEXT PRIMARY KEY, value) WITHOUT ROWID")
+    seed_ids = [book_id for book_id, title, author, qty in PRE_GENERATED_BOOKS]
+    placeholders = ", ".join("?" * len(seed_ids))
+    cursor.execute(f'''
+        INSERT INTO bookstore_meta (name, value)
+        SELECT 'seeded', 1 WHERE EXISTS (SELECT 1 FROM book WHERE id IN ({placeholders}))
+    ''', seed_ids)
+
+
+# Rows of book_changes kept for BookDatabases that have not caught up yet, older ones are trimmed every 1000 rows.
+# A BookDatabase that falls further behind than this rebuilds its indexes and snapshot instead
+CHANGE_LOG_ROWS = 10000
+
+
+def migrate_change_log(cursor):
+    """
+    Schema version 3. Add book_changes, a log of every insert, update and delete on book written by triggers, so
+    the writes of every program using the database are in it. A row holds the book's title and author before the
+    change (unless it was an insert) and its title, author and quantity after it (unless it was a delete).
+    BookDatabase reads the rows written by other connections to bring its fuzzy indexes and snapshot up to date,
+    see BookDatabase.catch_up.
+    """
+    cursor.execute('''
+        CREATE TABLE book_changes (
+            seq INTEGER PRIMARY KEY,
+            book_id INTEGER NOT NULL,
+            change TEXT NOT NULL,
+            old_title TEXT,
+            old_author TEXT,
+            title TEXT,
+            author TEXT,
+            qty INTEGER
+        )
+    ''')
+    inserted = "INSERT INTO book_changes (book_id, change, title, author, qty) VALUES (new.id, 'insert', new.title, new.author, new.qty);"
+    deleted = "INSERT INTO book_changes (book_id, change, old_title, old_author) VALUES (old.id, 'delete', old.title, old.author);"
+    cursor.execute(f"CREATE TRIGGER book_changes_insert AFTER INSERT ON book BEGIN {inserted} END")
+    cursor.execute(f"CREATE TRIGGER book_changes_delete AFTER DELETE ON book BEGIN {deleted} END")
+    cursor.execute('''
+        CREATE TRIGGER book_changes_update AFTER UPDATE ON book WHEN old.id = new.id BEGIN
+            INSERT INTO book_changes (book_id, change, old_title, old_author, title, author, qty)
+            VALUES (new.id, 'update', old.title, old.author, new.title, new.author, new.qty);
+        END
+    ''')
+    # A book given a new ID is logged as deleted under the old one and inserted under the new one
+    cursor.execute(f"CREATE TRIGGER book_changes_renumber AFTER UPDATE ON book WHEN old.id != new.id BEGIN {deleted} {inserted} END")
+    cursor.execute(f'''
+        CREATE TRIGGER book_changes_trim AFTER INSERT ON book_changes WHEN new.seq % 1000 = 0 BEGIN
+            DELETE FROM book_changes WHERE seq <= new.seq - {CHANGE_LOG_ROWS};
+        END
+    ''')
+
+
+# Schema migrations in order, migration n upgrades a database from PRAGMA user_version n-1 to n.
+# Only ever append to this list, released migrations must not change.
+SCHEMA_MIGRATIONS = [
+    migrate_unique_title_author,
+    migrate_metadata,
+    migrate_change_log,
+]
+SCHEMA_VERSION = len(SCHEMA_MIGRATIONS)
+
+
+# Oldest SQLite BookDatabase runs on, add_book uses RETURNING (3.35). The "fts" engine needs 3.34 as well as FTS5
+# and checks for it itself
+SQLITE_VERSION_NEEDED = (3, 35, 0)
+
+# Connection settings chosen with the profile argument of BookDatabase, any setting can also be overridden on its own:
+#   journal_mode, synchronous, cache_size, mmap_size, temp_store - the SQLite PRAGMAs of the same name
+#   busy_timeout - milliseconds to wait for a lock held by another connection before "database is locked"
+#   readers - number of extra read-only connections so several threads can search while one writes
+#   check_same_thread - False lets the connection be used from other threads (always the case when readers > 0)
+CONNECTION_PROFILES = {
+    # SQLite's defaults, as the program has always used
+    "default": {},
+    # Shared database with concurrent readers and a writer. In WAL mode readers never block the writer or each other,
+    # synchronous=NORMAL is still safe against corruption in WAL mode and only fsyncs at checkpoints
+    "concurrent": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -65536,
+        "mmap_size": 268435456,
+        "busy_timeout": 10000,
+        "readers": 4,
+    },
+    # Private database being bulk loaded, a crash can lose the most recent transactions
+    "bulk": {
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "cache_size": -262144,
+        "temp_store": "MEMORY",
+    },
+}
+PRAGMA_SETTINGS = ("journal_mode", "synchronous", "cache_size", "mmap_size", "temp_store")
+CONNECTION_SETTINGS = PRAGMA_SETTINGS + ("busy_timeout", "readers", "check_same_thread")
+
+
+def connection_settings(profile, overrides):
+    """
+    Combine a connection profile (name or dictionary) with individual setting overrides.
+    
+    Raises InvalidSettingError for an unknown profile or setting, or a PRAGMA value that is not a plain word or number.
+    """
+    if isinstance(profile, dict):
+        settings = dict(profile)
+    elif profile in CONNECTION_PROFILES:
+        settings = dict(CONNECTION_PROFILES[profile])
+    else:
+        raise InvalidSettingError(f'Unknown connection profile "{profile}", choose from {", ".join(CONNECTION_PROFILES)}.')
+    settings.update(overrides)
+    for name, value in settings.items():
+        if name not in CONNECTION_SETTINGS:
+            raise InvalidSettingError(f'Unknown connection setting "{name}".')
+        # PRAGMA values cannot be bound as parameters so only allow values that are safe to put in the statement
+        if name in PRAGMA_SETTINGS and not re.fullmatch(r"-?\w+", str(value)):
+            raise InvalidSettingError(f'Invalid value {value!r} for connection setting "{name}".')
+    return settings
+
+
+def open_connection(database_name, settings, check_same_thread=True, read_only=False):
+    """
+    Open an SQLite connection and apply the PRAGMA settings to it.
+    
+    Arguments:
+        database_name (string) of the SQLite database.
+        settings (dict) from connection_settings().
+        check_same_thread (boolean) passed on to sqlite3.connect.
+        read_only (boolean) stops the connection from writing (PRAGMA query_only).
+    """
+    options = {"check_same_thread": check_same_thread}
+    if "busy_timeout" in settings:
+        options["timeout"] = settings["busy_timeout"] / 1000
+    conn = sqlite3.connect(database_name, **options)
+    try:
+        for name in PRAGMA_SETTINGS:
+            if name in settings:
+                conn.execute(f"PRAGMA {name} = {settings[name]}")
+        if read_only:
+            conn.execute("PRAGMA query_only = ON")
+    except sqlite3.Error:
+        conn.close()
+        raise
+    return conn
+
+
+def select_in(conn, query, values):
+    """
+    Run a query with "IN ({placeholders})" for a list of values of any length, in chunks that keep well under
+    SQLite's limit on the number of bound parameters. Yields the rows of every chunk.
+    """
+    for start in range(0, len(values), 500):
+        chunk = values[start:start + 500]
+        yield from conn.execute(query.format(placeholders=", ".join("?" * len(chunk))), chunk)
+
+
+class ConnectionPool:
+    """
+    Fixed size pool of read-only connections to one database, shared between threads.
+    """
+    def __init__(self, database_name, settings, size):
+        self.connections = queue.LifoQueue()
+        self.opened = []
+        try:
+            for _ in range(size):
+                conn = open_connection(database_name, settings, check_same_thread=False, read_only=True)
+                self.opened.append(conn)
+                self.connections.put(conn)
+        except sqlite3.Error:
+            self.close()
+            raise
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Borrow a connection for the length of a with block, waiting if they are all in use.
+        """
+        conn = self.connections.get()
+        try:
+            yield conn
+        finally:
+            self.connections.put(conn)
+
+    def close(self):
+        """
+        Close every connection in the pool.
+        """
+        for conn in self.opened:
+            conn.close()
+        self.opened = []
+
 
 class BookDatabase:
-    def __init__(self, database_name):
+    """
+    Programmatic API over the 'book' table. Methods return Book records and result tuples and raise
+    BookstoreError subclasses, they never prompt or print. The interactive menu is built on top in main().
+    """
+    def __init__(self, database_name, profile="default", scorer=None, cache=None, snapshot=False, instrumentation=None,
+                 search_engine="difflib", **settings):
         """
         Initialize a BookDatabase object by connecting it to the SQLite database.
         
         Arguements:
             database_name (string). This is the name of the SQLite database to connect to.
+            profile (string or dict) is one of CONNECTION_PROFILES or a dictionary of connection settings.
+            scorer (FuzzyScorer) scores search candidates, by default one that uses every CPU for large searches.
+            A scorer given here may be shared, so it is left for the caller to close.
+            cache (SearchCache) holds recent search results, by default one of 1024 entries. False turns caching off.
+            snapshot (boolean) loads the whole table into a CatalogueSnapshot at start up, so searches and
+            get_book are answered from memory. Worth it for read heavy use, see snapshot_memory() for its size.
+            instrumentation (Instrumentation) times operations and counts rows and statements, see stats().
+            True gives one without hooks, by default there is none.
+            search_engine (string) is one of SEARCH_ENGINES.
+            settings are individual connection settings that override the profile, such as busy_timeout=2000.
+        
+        All writes go through one connection guarded by a lock. With readers > 0, reads and searches use
+        a pool of read-only connections so they can run on other threads while a write is in progress
+        (use the "concurrent" profile, or a WAL journal, so they are not blocked by it).
+        
+        Raises DatabaseError if the database cannot be opened or SQLite is older than SQLITE_VERSION_NEEDED,
+        or InvalidSettingError for a bad profile or search engine.
         """
+        if sqlite3.sqlite_version_info < SQLITE_VERSION_NEEDED:
+            raise DatabaseError(f'This program needs SQLite {".".join(map(str, SQLITE_VERSION_NEEDED))} or later, '
+                                f'Python is using SQLite {sqlite3.sqlite_version}.')
+        if search_engine not in SEARCH_ENGINES:
+            raise InvalidSettingError(f'Unknown search engine "{search_engine}", expected one of {", ".join(SEARCH_ENGINES)}.')
+        self.search_engine = search_engine
+        self.settings = connection_settings(profile, settings)
+        self.scorer = scorer or FuzzyScorer()
+        self.owns_scorer = scorer is None
+        self.cache = SearchCache() if cache is None else cache or None
+        self.instrumentation = Instrumentation() if instrumentation is True else instrumentation or None
+        # Moved on by every write so cached searches from before it are no longer used
+        self.generation = 0
+        # PRAGMA data_version of self.conn when it was last checked, and the last row of book_changes that the
+        # fuzzy indexes and snapshot are up to date with, see check_other_writes
+        self.data_version = None
+        self.change_seq = 0
+        # A private in-memory database cannot be shared between connections
+        readers = 0 if database_name == ":memory:" else self.settings.get("readers", 0)
+        check_same_thread = self.settings.get("check_same_thread", True) and not readers
+        # Fuzzy search indexes are built from the table on the first search and kept in sync by every write,
+        # as is the snapshot when there is one
+        self.title_index = None
+        self.author_index = None
+        self.snapshot = None
+        # Serializes use of self.conn, and of the fuzzy indexes, between threads
+        self.lock = threading.RLock()
+        self.index_lock = threading.RLock()
+        # Nesting depth of transaction() blocks, the thread they are on, whether an error has reverted them
+        # and whether they have changed the books (and so the indexes, snapshot and cache)
+        self.transaction_depth = 0
+        self.transaction_thread = None
+        self.transaction_reverted = False
+        self.transaction_changed = False
+        self.pool = None
         try:
-            self.conn = sqlite3.connect(database_name)
-            self.create_table()
+            self.conn = open_connection(database_name, self.settings, check_same_thread=check_same_thread)
         except sqlite3.Error as e:
-            print(f'Error accessing the database: {e}')
-            raise
+            raise DatabaseError(f'Error accessing the database: {e}') from e
+        if self.instrumentation is not None:
+            self.instrumentation.attach(self.conn)
+        self.create_table()
+        if readers:
+            try:
+                self.pool = ConnectionPool(database_name, self.settings, readers)
+            except sqlite3.Error as e:
+                self.conn.close()
+                raise DatabaseError(f'Error accessing the database: {e}') from e
+            if self.instrumentation is not None:
+                for conn in self.pool.opened:
+                    self.instrumentation.attach(conn)
+        if search_engine == "fts":
+            try:
+                self.add_search_vocabulary()
+            except BookstoreError:
+                self.close()
+                raise
+        self.check_other_writes()
+        if snapshot:
+            self.load_snapshot()
+
+    @contextlib.contextmanager
+    def reading(self):
+        """
+        Get a connection to read from for the length of a with block: a pooled read-only connection
+        when there is a pool, otherwise the main connection while holding its lock. Inside a transaction()
+        block its own thread reads from the main connection, so it sees the changes it has not committed yet.
+        """
+        if self.pool is None or self.transaction_thread == threading.get_ident():
+            with self.lock:
+                yield self.conn
+        else:
+            with self.pool.connection() as conn:
+                yield conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Group writes into one transaction for the length of a with block, so they are committed together
+        (one sync to disk instead of one per write) or not at all:
+        
+            with db.transaction():
+                db.add_book("Dune", "Frank Herbert", 5)
+                db.update_book("1984", "George Orwell", 0)
+        
+        The block holds the write lock, so other threads wait to write until it ends. If it raises, or a write
+        inside it failed and was reverted, every change it made is reverted and the fuzzy indexes and snapshot are
+        reloaded if it had changed them. Searches from other threads may see the changes before they are committed.
+        A transaction() block inside another joins the outer one.
+        
+        Raises DatabaseError if the transaction cannot be started or committed, or was reverted by an earlier error.
+        """
+        with self.lock:
+            if self.transaction_depth:
+                self.transaction_depth += 1
+                try:
+                    yield self
+                finally:
+                    self.transaction_depth -= 1
+                return
+            try:
+                # Take the write lock on the file straight away, so reads in the transaction stay consistent
+                # with its writes even when other programs use the database
+                self.conn.execute("BEGIN IMMEDIATE")
+            except sqlite3.Error as e:
+                raise DatabaseError(f'Problem occured while starting a transaction: {e}') from e
+            self.transaction_depth = 1
+            self.transaction_thread = threading.get_ident()
+            self.transaction_reverted = False
+            try:
+                # Other programs cannot write until the transaction ends, so what it reads from the indexes
+                # and the snapshot is up to date for the whole of it
+                self.check_other_writes()
+                self.transaction_changed = False
+                yield self
+                if self.transaction_reverted:
+                    raise DatabaseError('The transaction was reverted by an earlier error.')
+                try:
+                    self.conn.commit()
+                except sqlite3.Error as e:
+                    raise DatabaseError(f'Problem occured while committing a transaction: {e}') from e
+            except BaseException:
+                try:
+                    self.rollback()
+                except DatabaseError:
+                    # The error that ended the transaction is the one raised
+                    pass
+                # Nothing to undo in memory when no write got as far as the indexes, such as a rejected batch
+                if self.transaction_changed:
+                    self.reload_indexes()
+                raise
+            finally:
+                self.transaction_depth = 0
+                self.transaction_thread = None
+
+    def commit(self):
+        """
+        Commit the changes of a write, unless it is part of a transaction() block, which commits them at its end.
+        """
+        if not self.transaction_depth:
+            self.conn.commit()
+
+    def check_other_writes(self):
+        """
+        Look for changes committed to the database by other connections, such as another BookDatabase or another
+        program using the same file, which the fuzzy indexes, the snapshot and the search cache know nothing of.
+        If there are any, the indexes and snapshot catch up with them (see catch_up) and the cache is made stale.
+        
+        SQLite moves PRAGMA data_version of a connection on whenever another connection commits, never for its own
+        commits, so this is two cheap queries on the main connection. It is made before searches, get_book with
+        a snapshot and at the start of a transaction.
+        
+        Raises DatabaseError if SQLite fails.
+        """
+        # While another thread is writing the check is left to the next search rather than waiting for it,
+        # data_version keeps counting so nothing is missed
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            # Read first, so a commit by another connection after it is seen by data_version
+            last_change = self.last_change(self.conn)
+            data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            if self.data_version is None or data_version == self.data_version:
+                # Nothing committed by anyone else since the last check, so any newer rows of the log are
+                # this database's own writes, which the indexes and snapshot already have
+                with self.index_lock:
+                    self.change_seq = last_change
+            else:
+                self.catch_up()
+            self.data_version = data_version
+        except sqlite3.Error as e:
+            raise DatabaseError(f'Error accessing the database: {e}') from e
+        finally:
+            self.lock.release()
+
+    def last_change(self, conn):
+        """
+        Return the number of the latest row of the book_changes log, 0 if it is empty.
+        """
+        return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM book_changes").fetchone()[0]
+
+    def catch_up(self):
+        """
+        Apply the rows of the book_changes log after change_seq to the fuzzy indexes and snapshot, in order, and make
+        the search cache stale. Only the books that changed are touched: a change of quantity only updates the
+        snapshot, and the indexes are left alone. If the rows needed have been trimmed from the log, the indexes
+        are thrown away and the snapshot reloaded instead, as after an import.
+        
+        The rows include this database's own writes, which are already applied. Applying a row again changes
+        nothing, as it sets a book to how the row left it. Called by check_other_writes, holding the lock.
+        """
+        with self.index_lock:
+            if self.title_index is None and self.snapshot is None:
+                # Nothing in memory to bring up to date
+                rows = []
+                self.change_seq = self.last_change(self.conn)
+            else:
+                rows = self.conn.execute('''
+                    SELECT seq, book_id, change, old_title, old_author, title, author, qty FROM book_changes
+                    WHERE seq > ? ORDER BY seq
+                ''', (self.change_seq,)).fetchall()
+            missed = bool(rows) and rows[0][0] != self.change_seq + 1
+            if not missed:
+                for seq, book_id, change, old_title, old_author, title, author, qty in rows:
+                    if change == "update" and (old_title, old_author) == (title, author):
+                        self.index_quantity(book_id, qty)
+                        continue
+                    if change != "insert":
+                        self.unindex_book(book_id, old_title, old_author)
+                    if change != "delete":
+                        self.index_book(book_id, title, author, qty)
+                if rows:
+                    self.change_seq = rows[-1][0]
+        self.count(rows_scanned=len(rows))
+        if missed:
+            # Outside the index lock, reloading the snapshot takes a connection before it
+            self.reload_indexes()
+        else:
+            self.catalogue_changed()
+
+    def timed(self, name):
+        """
+        Time the length of a with block under name, if the database has instrumentation.
+        """
+        if self.instrumentation is None:
+            return NOT_TIMED
+        return self.instrumentation.timer(name)
+
+    def count(self, rows_scanned=0, rows_scored=0):
+        """
+        Add to the instrumentation row counters, if the database has instrumentation.
+        """
+        if self.instrumentation is not None:
+            self.instrumentation.count(rows_scanned, rows_scored)
+
+    def stats(self):
+        """
+        Return the InstrumentationStats of the database, or None if it has no instrumentation.
+        """
+        return self.instrumentation.stats() if self.instrumentation is not None else None
     
+    @instrumented
     def populate_table(self):
         """
-        Creates a table at start up (if none) and inserts the required 5 books with their details.
-        Make sure there isnt a table that already exists
+        Insert the pre-generated books with their details, once. The database records that they have been added,
+        so later calls (every start of the program) do nothing, even if some of them have since been deleted.
+        A book already on the system with the same ID or title and author is left as it is.
+        
+        Returns the number of books inserted. Raises DatabaseError (after reverting) if they cannot be inserted.
+        """
+        if self.seeded:
+            return 0
+        # Convert titles and authors to uppercase for consistency in database
+        books_to_insert = [(id, title.upper(), author.upper(), qty) for id, title, author, qty in PRE_GENERATED_BOOKS]
+        inserted = []
+        with self.lock:
+            try:
+                cursor = self.conn.cursor()
+                if cursor.execute("SELECT value FROM bookstore_meta WHERE name = 'seeded'").fetchone():
+                    self.seeded = True
+                    return 0
+                for book in books_to_insert:
+                    cursor.execute("INSERT OR IGNORE INTO book (id, title, author, qty) VALUES (?, ?, ?, ?)", book)
+                    if cursor.rowcount == 1:
+                        inserted.append(book)
+                cursor.execute("INSERT OR REPLACE INTO bookstore_meta (name, value) VALUES ('seeded', 1)")
+                self.commit()
+            except sqlite3.Error as e:
+                self.rollback()
+                raise DatabaseError(f'Problem occured while trying to populate table with pre-generated books: {e}.') from e
+            self.seeded = True
+            for book_id, title, author, qty in inserted:
+                self.index_book(book_id, title, author, qty)
+            self.catalogue_changed()
+        return len(inserted)
+
+    def startup_state(self):
+        """
+        Read the schema version and whether the pre-generated books have been added, in one query.
+        
+        Returns (schema version, seeded). seeded is None when the database has no bookstore_meta table yet.
         """
         try:
-            cursor = self.conn.cursor()
-            cursor.execute("SELECT name FROM sqlite_master WHERE type ='table'")
-            table_already_exists = cursor.fetchone()
+            version, seeded = self.conn.execute('''
+                SELECT user_version, (SELECT value FROM bookstore_meta WHERE name = 'seeded') FROM pragma_user_version
+            ''').fetchone()
+            return version, bool(seeded)
+        except sqlite3.OperationalError:
+            # A new or older database, without the bookstore_meta table
+            return self.conn.execute("PRAGMA user_version").fetchone()[0], None
 
-            if not table_already_exists:
+    def create_table(self):
+        """
+        Create a table referenced as 'book' in the database if one doesnt already exist.
+        It stores info about the books inserted by the user, namely their title, author and amount of books (quantity). 
+        It also gives an automated unique ID to the book when it needs to be called by a function.
+        
+        A database already at SCHEMA_VERSION is left alone after one query, without writing or locking it.
+        
+        No arguements are taken
+        """
+        with self.lock:
+            try:
+                version, self.seeded = self.startup_state()
+            except sqlite3.Error as e:
+                raise DatabaseError(f'Error accessing the database: {e}') from e
+            if version == SCHEMA_VERSION:
+                return
+            try:
+                cursor = self.conn.cursor()
                 cursor.execute('''
-                    CREATE TABLE book (
+                    CREATE TABLE IF NOT EXISTS book (
                         id INTEGER PRIMARY KEY,
                         title TEXT,
                         author TEXT,
                         qty INTEGER
-                        )
-                    ''')
+                    )
+                ''')
                 self.conn.commit()
-                print("Table called book create.")   
-
-            books_to_insert = [
-            (3001, "A Tale of Two Cities", "Charles Dickens", 30),
-            (3002, "Harry Potter and the Philosopher's Stone", "J.K. Rowling", 40),
-            (3003, "The Lion, the Witch and the Wardrobe", "C.S. Lewis", 25),
-            (3004, "The Lord of the Rings", "J.R.R. Tolkien", 37),
-            (3005, "Alice in Wonderland", "Lewis Carroll", 12),
-            (3006, "To Kill a Mockingbird", "Harper Lee", 55),
-            (3007, "1984", "George Orwell", 33),
-            (3008, "The Great Gatsby", "F. Scott Fitzgerald", 1),
-            (3009, "War and Peace", "Leo Tolstoy", 23),
-            (3010, "Beowolf", "J.R.R. Tolkien", 6),
-            (3011, "The Beautiful and Damned", "F. Scott Fitzgerald", 8),
-            (3012, "A Tale of Two Cities", "Agatha Christie", 1056),
-            ]
-
-            # Convert titles and authors to uppercase for consistency in database
-            books_to_insert = [(id, title.upper(), author.upper(), qty) for id, title, author, qty in books_to_insert]
-
-            cursor.executemany("INSERT INTO book (id, title, author, qty) VALUES (?, ?, ?, ?)", books_to_insert)
-            self.conn.commit()
-            print("Pre-generated books added successfully.")
+            except sqlite3.Error as e:
+                raise DatabaseError(f'Error creating the database table: {e}') from e
+            self.migrate()
+
+    def add_search_vocabulary(self):
+        """
+        Add the search vocabulary the "fts" search engine needs, if the database does not have it yet
+        (see create_search_vocabulary). It is only added on demand as its triggers slow down every write to the
+        book table, and once added it stays, whichever engine the database is opened with afterwards.
+        
+        Raises InvalidSettingError if this SQLite has no FTS5 trigram tokenizer or DatabaseError if SQLite fails.
+        """
+        with self.lock:
+            try:
+                cursor = self.conn.cursor()
+                # Checked again once the write lock is held, another program may be adding it at the same time
+                cursor.execute("BEGIN IMMEDIATE")
+                if cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'book_vocab_fts'").fetchone() is None:
+                    create_search_vocabulary(cursor)
+                self.conn.commit()
+            except InvalidSettingError:
+                self.rollback()
+                raise
+            except sqlite3.Error as e:
+                self.rollback()
+                raise DatabaseError(f'Problem occured while adding the search vocabulary: {e}') from e
 
+    def schema_version(self):
+        """
+        Return the schema version of the database (its PRAGMA user_version).
+        """
+        try:
+            with self.reading() as conn:
+                return conn.execute("PRAGMA user_version").fetchone()[0]
         except sqlite3.Error as e:
-            print(f'Problem occured while trying to populate table with pre-generated books: {e}. Possibly already table exists.')
-            self.rollback()
+            raise DatabaseError(f'Problem occured while reading the schema version: {e}') from e
 
-    def create_table(self):
+    @instrumented
+    def migrate(self):
         """
-        Create a table referenced as 'book' in the database if one doesnt already exist.
-        It stores info about the books inserted by the user, namely their title, author and amount of books (quantity). 
-        It also gives an automated unique ID to the book when it needs to be called by a function.
+        Upgrade the database in place by applying every migration in SCHEMA_MIGRATIONS that it has not had yet.
+        Each migration runs in its own transaction together with the update of PRAGMA user_version,
+        so an interrupted upgrade can simply be run again.
+
+        Returns the schema version of the database afterwards. Raises DatabaseError if the database was
+        created by a newer version of the program or a migration fails.
+        """
+        with self.lock:
+            current_version = self.schema_version()
+            if current_version > SCHEMA_VERSION:
+                raise DatabaseError(f'The database has schema version {current_version} but this program only supports up to {SCHEMA_VERSION}.')
+            if current_version == SCHEMA_VERSION:
+                return current_version
+            # Used by migrations to normalize text the same way as normalize_book()
+            self.conn.create_function("normalize_text", 1, lambda text: text.strip().upper() if isinstance(text, str) else text,
+                                      deterministic=True)
+            for version in range(current_version + 1, SCHEMA_VERSION + 1):
+                try:
+                    cursor = self.conn.cursor()
+                    cursor.execute("BEGIN")
+                    SCHEMA_MIGRATIONS[version - 1](cursor)
+                    # PRAGMA does not take bound parameters, version is always an int from the range above
+                    cursor.execute(f"PRAGMA user_version = {version}")
+                    self.conn.commit()
+                except sqlite3.Error as e:
+                    self.rollback()
+                    raise DatabaseError(f'Problem occured while upgrading the database to schema version {version}: {e}') from e
+            return SCHEMA_VERSION
+
+    @instrumented
+    def get_book(self, book_id):
+        """
+        Look up a book by its unique ID.
         
-        No arguements are taken
+        Returns the Book. Raises BookNotFoundError if there is no book with that ID.
+        """
+        if self.snapshot is not None:
+            self.check_other_writes()
+            with self.index_lock:
+                book = self.snapshot.get(book_id)
+            if book is None:
+                raise BookNotFoundError(f'No book with ID {book_id} found in the database.')
+            return book
+        try:
+            with self.reading() as conn:
+                row = conn.execute("SELECT id, title, author, qty FROM book WHERE id = ?", (book_id,)).fetchone()
+        except sqlite3.Error as e:
+            raise DatabaseError(f'Problem occured while trying to find a book: {e}') from e
+        if not row:
+            raise BookNotFoundError(f'No book with ID {book_id} found in the database.')
+        return Book(*row)
+
+    @instrumented
+    def find_book(self, title, author):
+        """
+        Look up a book by its exact title and author (in any case).
+        
+        Returns the Book or None if it is not on the system.
+        """
+        title, author = normalize_book(title, author)
+        try:
+            with self.reading() as conn:
+                row = conn.execute("SELECT id, title, author, qty FROM book WHERE title = ? AND author = ?", (title, author)).fetchone()
+        except sqlite3.Error as e:
+            raise DatabaseError(f'Problem occured while trying to find a book: {e}') from e
+        return Book(*row) if row else None
+
+    @instrumented
+    def add_book(self, title, author, quantity=1):
+        """
+        Adds a book to the database by entering the title and author, a unique ID will be automatically assigned. 
+        If a book with same title and author already exists, the quantity is added to the existing quantity instead.
+        
+        Takes on arguements:
+            title (string) which represents the title of the book.
+            author (string) which represents the author of the book.
+            quantity=1 (int) is the amount of books to add. New books added has default setting of 1. 
+        
+        The title and author are converted to upper case in the database for consistency.
+        
+        Returns an AddResult with the Book as it now is and whether a new row was created.
+        """
+        title, author = normalize_book(title, author)
+        check_quantity(quantity)
+        with self.lock:
+            try:
+                # Interact with the database by creating a cursor object
+                cursor = self.conn.cursor()
+                # The unique (title, author) index turns a book already on the system into a no-op insert.
+                # A single "ON CONFLICT DO UPDATE" cannot say which it did: the update leaves lastrowid at the
+                # connection's previous insert, which can be this very book
+                cursor.execute("INSERT INTO book (title, author, qty) VALUES (?, ?, ?) ON CONFLICT (title, author) DO NOTHING",
+                               (title, author, quantity))
+                created = cursor.rowcount == 1
+                if created:
+                    book = Book(cursor.lastrowid, title, author, quantity)
+                else:
+                    cursor.execute("UPDATE book SET qty = qty + ? WHERE title = ? AND author = ? RETURNING id, qty",
+                                   (quantity, title, author))
+                    book_id, qty = cursor.fetchone()
+                    book = Book(book_id, title, author, qty)
+                self.commit()
+            except sqlite3.Error as e:
+                self.rollback() # Revert changes made if error found
+                raise DatabaseError(f'Error adding a book to the database: {e}') from e
+            if created:
+                self.index_book(book.id, title, author, book.qty)
+            else:
+                self.index_quantity(book.id, book.qty)
+            self.catalogue_changed()
+        return AddResult(book, created)
+
+    @instrumented
+    def update_book(self, title, author, quantity):
+        """
+        Update the quantity of a specific book with inserted title and author. Only need to update the quanitity as there is a separate method to delete a book.
+        If the quantity is set to 0 then the book is removed from the database.
+        
+        Arguements include the title (string), author (string) and quantity (int).
+        
+        Returns an UpdateResult. Raises BookNotFoundError if the book doesnt exist.
+        """
+        title, author = normalize_book(title, author)
+        check_quantity(quantity)
+        with self.lock:
+            try:
+                cursor = self.conn.cursor()
+                cursor.execute("SELECT id, qty FROM book WHERE title = ? AND author = ?", (title, author))
+                row = cursor.fetchone()
+                if not row:
+                    raise BookNotFoundError(f'No book with the title "{title}" by "{author}" found in the database.')
+                book_id, old_qty = row
+                if quantity == 0:
+                    cursor.execute("DELETE FROM book WHERE id = ?", (book_id,))
+                else:
+                    cursor.execute("UPDATE book SET qty = ? WHERE id = ?", (quantity, book_id))
+                self.commit()
+            except sqlite3.Error as e:
+                self.rollback()
+                raise DatabaseError(f'Problem occured while trying to update a book: {e}') from e
+            if quantity == 0:
+                self.unindex_book(book_id, title, author)
+            else:
+                self.index_quantity(book_id, quantity)
+            self.catalogue_changed()
+        return UpdateResult(Book(book_id, title, author, quantity), old_qty, quantity == 0)
+
+    @instrumented
+    def delete_book(self, title=None, author=None, book_id=None):
+        """
+        Delete a book from the database, either by its unique ID or by its title AND author.
+        
+        Takes on arguememts:
+            title (string) and author (string) of the book
+            book_id (int) is the books unique ID number that can be shown when searching for a book
+        
+        Returns the deleted Book. Raises BookNotFoundError if there is no such book, or InvalidBookError if
+        neither the ID nor the title and author are given.
+        """
+        if book_id is None and (title is None or author is None):
+            raise InvalidBookError("Give either the book's ID or its title and author to delete it.")
+        with self.lock:
+            # Deleting by book's unique ID, otherwise by books title AND author
+            if book_id is not None:
+                book = self.get_book(book_id)
+            else:
+                book = self.find_book(title, author)
+                if book is None:
+                    title, author = normalize_book(title, author)
+                    raise BookNotFoundError(f'No book with the title "{title}" by "{author}" found in the database.')
+            try:
+                cursor = self.conn.cursor()
+                cursor.execute("DELETE FROM book WHERE id = ?", (book.id,))
+                self.commit()
+            except sqlite3.Error as e:
+                self.rollback()
+                raise DatabaseError(f'Problem occured while trying to delete a book: {e}') from e
+            self.unindex_book(book.id, book.title, book.author)
+            self.catalogue_changed()
+        return book
+
+    @instrumented
+    def apply_quantity_deltas(self, deltas):
+        """
+        Add to or take away from the quantity of many books at once, in one transaction written with executemany,
+        for feeds of stock received and books sold. Either every change is made or none is.
+        
+        Arguments:
+            deltas (iterable) of (book_id, delta) pairs, delta being a whole number to add to the quantity
+            (negative to take away). A book can appear more than once, its deltas are applied in order.
+        
+        A book whose quantity reaches 0 is removed, as with update_book.
+        
+        Returns a list of UpdateResult, one for each delta in order. Raises BookNotFoundError for an unknown ID,
+        InvalidBookError if a change is not a pair or its delta is not a whole number or would take a quantity
+        below 0, and DatabaseError if SQLite fails. Nothing is written in any of these cases.
+        """
+        deltas = list(deltas)
+        for change in deltas:
+            if not isinstance(change, (tuple, list)) or len(change) != 2:
+                raise InvalidBookError(f'Quantity changes must be (book ID, change) pairs, got {change!r}.')
+            check_book_id(change[0])
+            if isinstance(change[1], bool) or not isinstance(change[1], int):
+                raise InvalidBookError(f'Quantity change must be a whole number, got {change[1]!r}.')
+        with self.transaction():
+            try:
+                books = {book[0]: Book(*book) for book in self.fetch_books_by_id({book_id for book_id, delta in deltas})}
+            except sqlite3.Error as e:
+                raise DatabaseError(f'Problem occured while trying to update books: {e}') from e
+            # Work out every new quantity before writing anything
+            quantities = {}
+            # Books a change has taken to 0, a book already on the system with 0 can still be added to
+            removed = set()
+            results = []
+            for book_id, delta in deltas:
+                book = books.get(book_id)
+                if book is None:
+                    raise BookNotFoundError(f'No book with ID {book_id} found in the database.')
+                if book_id in removed:
+                    raise BookNotFoundError(f'Book with ID {book_id} was removed by an earlier change in the same batch.')
+                previous_qty = quantities.get(book_id, book.qty)
+                qty = previous_qty + delta
+                if qty < 0:
+                    raise InvalidBookError(f'Only {previous_qty} of "{book.title}" by "{book.author}" on the system, cannot take away {-delta}.')
+                quantities[book_id] = qty
+                if qty == 0:
+                    removed.add(book_id)
+                results.append(UpdateResult(book._replace(qty=qty), previous_qty, qty == 0))
+            try:
+                cursor = self.conn.cursor()
+                cursor.executemany("UPDATE book SET qty = ? WHERE id = ?",
+                                   [(qty, book_id) for book_id, qty in quantities.items() if book_id not in removed])
+                cursor.executemany("DELETE FROM book WHERE id = ?", [(book_id,) for book_id in removed])
+            except sqlite3.Error as e:
+                self.rollback()
+                raise DatabaseError(f'Problem occured while trying to update books: {e}') from e
+            for book_id, qty in quantities.items():
+                if book_id in removed:
+                    self.unindex_book(book_id, books[book_id].title, books[book_id].author)
+                else:
+                    self.index_quantity(book_id, qty)
+            self.catalogue_changed()
+        return results
+
+    @instrumented
+    def apply_operations(self, operations):
+        """
+        Apply a sequence of writes atomically in one transaction. Each operation is a tuple of:
+            ("add", title, author, quantity) as add_book
+            ("adjust", book_id, delta) as apply_quantity_deltas, a run of adjustments is written with one executemany
+            ("update", title, author, quantity) as update_book
+            ("delete", book_id) as delete_book
+        
+        Returns a list with the result of each operation in order (AddResult, UpdateResult or the deleted Book).
+        If any operation fails every one is reverted and its error raised. An unknown operation, one with the wrong
+        number of values or a book ID that is not a whole number raises InvalidBookError before anything is written.
+        """
+        operations = list(operations)
+        for operation in operations:
+            if not isinstance(operation, (tuple, list)) or not operation or operation[0] not in OPERATION_SIZES:
+                raise InvalidBookError(f'Unknown operation {operation!r}, expected "add", "adjust", "update" or "delete".')
+            if len(operation) != OPERATION_SIZES[operation[0]]:
+                raise InvalidBookError(f'A "{operation[0]}" operation has {OPERATION_SIZES[operation[0]]} values, got {operation!r}.')
+            if operation[0] in ("adjust", "delete"):
+                check_book_id(operation[1])
+        results = []
+        deltas = []
+        with self.transaction():
+            for operation in operations:
+                kind = operation[0]
+                if kind == "adjust":
+                    deltas.append(operation[1:])
+                    continue
+                if deltas:
+                    results.extend(self.apply_quantity_deltas(deltas))
+                    deltas = []
+                if kind == "add":
+                    results.append(self.add_book(*operation[1:]))
+                elif kind == "update":
+                    results.append(self.update_book(*operation[1:]))
+                else:
+                    results.append(self.delete_book(book_id=operation[1]))
+            if deltas:
+                results.extend(self.apply_quantity_deltas(deltas))
+        return results
+
+    @instrumented
+    def search_books(self, query, search_by_title=True, threshold=0.75):
+        """
+        Search books by title or author utilizing a matching search algorithm to find books with similar titles or authors, every search is converted to upper case
+        since that is the format of the database. 
+        
+        Handle mispelt/human error by adding a percentage error check for similar spelt titles or similar spelt books.
+        
+        Takes on arguements:
+            query (string) which is the search query of title or author
+            search_by_title (boolean statement). If its True, search by title. If not, search by author.
+            threshold (float) 0-1 threshold to consider a similar matching title. 
+            
+        - Books are shortlisted from the fuzzy indexes and a 'matching score' is calculated for each title or author
+        - The matches are sorted with the highest match first
+        - If there are no matches, the closest title or author above the suggestion threshold (0.75 ~ 75%)
+          is suggested instead (incase for spelling errors)
+        
+        Returns a SearchResult of (Book, score) matches and the suggestion (None when there are matches).
+        """
+        # The search runs in three steps so that the CPU heavy scoring in the middle can be moved elsewhere,
+        # as AsyncBookDatabase does
+        self.check_other_writes()
+        query = self.search_key(query, search_by_title)
+        key = (query, search_by_title, threshold)
+        generation, result = self.cached_search(key)
+        if result is None:
+            index = self.search_index(search_by_title)
+            candidates, scored = self.scored_candidates(query, search_by_title, threshold, index)
+            result = self.search_results(search_by_title, candidates, scored, index)
+            self.cache_search(key, generation, result)
+        return result
+
+    @instrumented
+    def search_page(self, query, search_by_title=True, threshold=0.75, limit=20, offset=0, after=None):
+        """
+        One page of search_books results, best first, for broad searches that match too many books to show at once.
+        Only the best offset + limit matches are kept while ranking (in a bounded heap) and only the page's books
+        are fetched, so memory does not grow with the number of matches.
+        
+        Takes on arguements:
+            query, search_by_title and threshold as search_books.
+            limit (int) is the most matches on the page.
+            offset (int) is the number of matches to skip first.
+            after (tuple) is the next_cursor of the previous page, the page starts at the match after it.
+            Unlike an offset it still lines up if books are added or removed between pages.
+        
+        Returns a SearchPage. The suggestion is only made when nothing matched at all.
+        Raises InvalidSettingError for a limit below 1 or an offset below 0.
+        """
+        if limit < 1 or offset < 0:
+            raise InvalidSettingError(f'A page needs a limit of at least 1 and an offset of at least 0, got {limit} and {offset}.')
+        self.check_other_writes()
+        query = self.search_key(query, search_by_title)
+        key = (query, search_by_title, threshold, limit, offset, after)
+        generation, page = self.cached_search(key)
+        if page is not None:
+            return page
+        index = self.search_index(search_by_title)
+        candidates, scored = self.scored_candidates(query, search_by_title, threshold, index)
+        with self.timed("search.fetch"):
+            keys = self.ranked_keys(search_by_title, candidates, scored, index)
+            if after is not None:
+                keys = (ranking for ranking in keys if ranking > (-after[0],) + tuple(after[1:]))
+            # One more than the page holds tells whether there is a next page
+            best = heapq.nsmallest(offset + limit + 1, keys)
+            page_keys = best[offset:offset + limit]
+            matches = list(self.ranked_books(page_keys))
+        next_cursor = None
+        if len(best) > offset + limit and page_keys:
+            # The last ranking key with the score the right way round
+            next_cursor = (-page_keys[-1][0],) + page_keys[-1][1:]
+        suggestion = None if scored.matches else self.suggestion(search_by_title, candidates, scored, index)
+        page = SearchPage(matches, suggestion, next_cursor)
+        self.cache_search(key, generation, page)
+        return page
+
+    def iter_search(self, query, search_by_title=True, threshold=0.75, after=None, batch_size=100):
+        """
+        Stream the results of search_books, best first, fetching the books batch_size at a time as they are used.
+        Breaking out of the loop early skips fetching the rest, and ranking the rest: the matches are kept in a heap
+        of ranking keys that is only sorted as far as it is read.
+        
+        Arguments are as search_page, without a suggestion. Yields (Book, score) pairs.
+        Raises InvalidSettingError for a batch_size below 1.
+        """
+        if batch_size < 1:
+            raise InvalidSettingError(f'Books are fetched at least 1 at a time, got a batch size of {batch_size}.')
+        self.check_other_writes()
+        query = self.search_key(query, search_by_title)
+        index = self.search_index(search_by_title)
+        candidates, scored = self.scored_candidates(query, search_by_title, threshold, index)
+        keys = self.ranked_keys(search_by_title, candidates, scored, index)
+        if after is not None:
+            keys = (ranking for ranking in keys if ranking > (-after[0],) + tuple(after[1:]))
+        keys = list(keys)
+        heapq.heapify(keys)
+        while keys:
+            batch = [heapq.heappop(keys) for _ in range(min(batch_size, len(keys)))]
+            yield from self.ranked_books(batch)
+
+    def search_key(self, query, search_by_title):
+        """
+        Put a query in the form the titles or authors are searched in: upper case titles, and author keys for
+        the "difflib" engine's author index.
+        """
+        if search_by_title or self.search_engine == "fts":
+            return query.upper()
+        return author_key(query)
+
+    def catalogue_changed(self):
+        """
+        Record that the books have changed, which makes every cached search result stale.
+        """
+        with self.lock:
+            self.generation += 1
+            if self.transaction_depth:
+                self.transaction_changed = True
+
+    def cached_search(self, key):
+        """
+        Look up a search in the cache.
+        
+        Returns the current generation, to be passed to cache_search once the search is done, and the cached
+        SearchResult or None.
+        """
+        # Read before searching, so a write during the search makes the result stale rather than cached as current
+        generation = self.generation
+        if self.cache is None:
+            return generation, None
+        with self.timed("search.cache"):
+            return generation, self.cache.get(key, generation)
+
+    def cache_search(self, key, generation, result):
+        """
+        Store a SearchResult worked out at the generation returned by cached_search.
+        """
+        if self.cache is not None:
+            self.cache.put(key, generation, result)
+
+    def search_index(self, search_by_title):
+        """
+        Return the fuzzy index a title or author search runs on, building the indexes first if need be, or None
+        for the "fts" engine. A search takes the index once and passes it to every step: writes change an index
+        in place under index_lock, but an import, a reverted transaction or writes by another program can throw
+        both away at any time (see reload_indexes), so a step reading self.title_index or self.author_index again
+        could find None or a newer index.
+        
+        Raises DatabaseError if SQLite fails while the indexes are built.
+        """
+        if self.search_engine == "fts":
+            return None
+        try:
+            title_index, author_index = self.load_indexes()
+        except sqlite3.Error as e:
+            raise DatabaseError(f'Problm occured searching for a book: {e}') from e
+        return title_index if search_by_title else author_index
+
+    def search_candidates(self, query, search_by_title, threshold, index):
+        """
+        First step of search_books: shortlist the titles or authors worth scoring from the fuzzy indexes.
+        
+        Arguments:
+            query (string) from search_key.
+            search_by_title (boolean) chooses between titles and authors.
+            threshold (float) 0-1 lowest score for a book to be returned.
+            index (FuzzyIndex) from search_index, also passed to the later steps.
+        
+        Returns a list of titles or author keys in table order, followed by any other author keys that sound
+        like the query.
+        """
+        # Suggestions are only ever made when nothing reaches the threshold, so a threshold at or below
+        # the suggestion threshold means nothing below the threshold needs scoring
+        cutoff = min(threshold, SUGGESTION_THRESHOLD)
+        if self.search_engine == "fts":
+            return self.fts_candidates(query, "title" if search_by_title else "author", cutoff)
+        with self.timed("search.candidates"), self.index_lock:
+            candidates = index.candidates(query, cutoff)
+            if search_by_title:
+                return candidates
+            shortlisted = set(candidates)
+            sound_alikes = [key for key in index.sounds_like(query) if key not in shortlisted]
+            sound_alikes.sort(key=lambda key: min(index.book_ids(key)))
+            return candidates + sound_alikes
+
+    def fts_candidates(self, query, kind, cutoff):
+        """
+        Shortlist titles or authors (kind) from the FTS5 trigram index: the FTS_CANDIDATES sharing the most
+        trigrams with the query, as ranked by SQLite. A query too short to have a trigram shortlists every title or
+        author short enough to reach the cutoff.
+        
+        Returns a list of titles or authors, best ranked first.
+        """
+        trigrams = sorted({query[i:i + 3] for i in range(len(query) - 2)})
+        try:
+            with self.timed("search.candidates"), self.reading() as conn:
+                if trigrams:
+                    # Each trigram quoted as an FTS5 string, any of them in the kind's column
+                    match = f'{kind} : (' + " OR ".join('"' + trigram.replace('"', '""') + '"' for trigram in trigrams) + ")"
+                    rows = conn.execute('''
+                        SELECT book_vocab.term FROM book_vocab_fts JOIN book_vocab ON book_vocab.id = book_vocab_fts.rowid
+                        WHERE book_vocab_fts MATCH ? ORDER BY book_vocab_fts.rank LIMIT ?
+                    ''', (match, FTS_CANDIDATES))
+                else:
+                    # ratio() is at most 2 * shorter / (total length)
+                    longest = len(query) * (2 - cutoff) / cutoff if cutoff > 0 else math.inf
+                    rows = conn.execute("SELECT term FROM book_vocab WHERE kind = ? AND length(term) <= ? ORDER BY id", (kind, longest))
+                return [term for term, in rows]
+        except sqlite3.Error as e:
+            raise DatabaseError(f'Problm occured searching for a book: {e}') from e
+
+    def scored_candidates(self, query, search_by_title, threshold, index):
+        """
+        The first two steps of search_books: shortlist the candidates and score them.
+        
+        Returns the candidates and their ScoreResult.
+        """
+        candidates = self.search_candidates(query, search_by_title, threshold, index)
+        self.count(rows_scored=len(candidates))
+        with self.timed("search.scoring"):
+            scored = self.scorer.score(query, candidates, threshold)
+        return candidates, self.with_sound_alikes(query, search_by_title, candidates, scored, index)
+
+    def with_sound_alikes(self, query, search_by_title, candidates, scored, index):
+        """
+        When an author search matched nothing and no author is spelt closely enough to suggest, suggest the author
+        that sounds like the query with the highest score instead ("JON SMYTHE" suggests "JOHN SMITH").
+        Sound-alikes are only ever matches when they reach the threshold like any other author, and title searches
+        are returned as they are.
+        
+        Returns a ScoreResult.
+        """
+        if search_by_title or self.search_engine == "fts" or scored.matches or scored.best:
+            return scored
+        with self.index_lock:
+            sound_alikes = index.sounds_like(query)
+        best = None
+        for position, candidate in enumerate(candidates):
+            if candidate in sound_alikes:
+                score = difflib.SequenceMatcher(None, query, candidate).ratio()
+                if best is None or score > best[1]:
+                    best = (position, score)
+        return scored._replace(best=best)
+
+    def search_results(self, search_by_title, candidates, scored, index):
+        """
+        Last step of search_books: fetch the books whose title or author matched, or work out the suggestion if none did.
+        
+        Arguments:
+            search_by_title and index as given to search_candidates.
+            candidates (list) returned by search_candidates.
+            scored (ScoreResult) of the candidates, from FuzzyScorer.score.
+        
+        Returns a SearchResult, matches are sorted with the highest score first. Equal scores are in table order
+        for titles, and for authors alphabetically by author and then title, so each author's books are listed
+        alphabetically.
+        """
+        with self.timed("search.fetch"):
+            keys = sorted(self.ranked_keys(search_by_title, candidates, scored, index))
+            if not keys:
+                return SearchResult([], self.suggestion(search_by_title, candidates, scored, index))
+            return SearchResult(list(self.ranked_books(keys)), None)
+
+    def suggestion(self, search_by_title, candidates, scored, index):
+        """
+        Suggestion for corrected title or author if no match and threshold critera is met,
+        the scoring pass (and with_sound_alikes) already found the best candidate. Returns it or None.
+        """
+        if scored.best:
+            return self.display_value(search_by_title, candidates[scored.best[0]], index)
+        return None
+
+    def display_value(self, search_by_title, candidate, index):
+        """
+        Return the title or author to show for a candidate, the author as written for an author key.
+        """
+        if search_by_title or self.search_engine == "fts":
+            return candidate
+        with self.index_lock:
+            return index.display(candidate)
+
+    def ranked_keys(self, search_by_title, candidates, scored, index):
+        """
+        Yield a ranking key for every matched book, which sort best first: (-score, ID) for a title search
+        and (-score, author, title, ID) for an author search. Must be read to the end, it holds a lock until then.
+        The whole key is the cursor search_page gives for the next page, with the score the right way round.
+        """
+        if self.search_engine == "fts":
+            yield from self.fts_ranked_keys(search_by_title, candidates, scored)
+            return
+        with self.index_lock:
+            if search_by_title:
+                for position, score in scored.matches:
+                    for book_id in index.book_ids(candidates[position]):
+                        yield -score, book_id
+                return
+            for position, score in scored.matches:
+                key = candidates[position]
+                for book_id in index.book_ids(key):
+                    # By key rather than as written, so every spelling of an author is listed together by title
+                    yield -score, key, index.author_and_title(book_id)[1], book_id
+
+    def fts_ranked_keys(self, search_by_title, candidates, scored):
         """
+        ranked_keys for the "fts" engine, which has no in-memory index: the books with a matched title or
+        author are looked up with the book table's indexes.
+        """
+        column = "title" if search_by_title else "author"
+        scores = {candidates[position]: score for position, score in scored.matches}
+        terms = list(scores)
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS book (
-                    id INTEGER PRIMARY KEY,
-                    title TEXT,
-                    author TEXT,
-                    qty INTEGER
-                )
-            ''')
-            self.conn.commit()
+            with self.reading() as conn:
+                for book_id, author, title in select_in(conn, f"SELECT id, author, title FROM book WHERE {column} IN ({{placeholders}})", terms):
+                    if search_by_title:
+                        yield -scores[title], book_id
+                    else:
+                        yield -scores[author], author, title, book_id
         except sqlite3.Error as e:
-            print(f'Error creating the database table: {e}')
-            raise
+            raise DatabaseError(f'Problm occured searching for a book: {e}') from e
 
-    def add_book(self, title, author, quantity=1):
+    def ranked_books(self, keys):
         """
-        Adds a book to the database by entering the title and author, a unique ID will be automatically assigned. 
-        If a book with same title and author already exists, the user will be asked if he/she would want to add one 
-        more to already existing quantity. If there is no existing book, then a new one is created and the user has an 
-        option of updating the quantity of books.
-        If no quantity is added, the new book is added to the database with a default quantity value of 1.
-        
-        Takes on arguements:
-            title (string) which represents the title of the book.
-            author (string) which represents the author of the book.
-            quantity=1 (int) is the amount of books in the database. New books added has default setting of 1. 
-        
-        The title and author are converted to upper case in the database for consistency
+        Fetch the books for a list of ranking keys from ranked_keys, yielding (Book, score) pairs in the
+        same order. Books deleted since they were scored are left out.
         """
         try:
-            # Convert to title case for books and authors to keep a consistent format in database
-            title = title.upper()
-            author = author.upper() 
-            # Interact with the database by creating a cursor object
-            cursor = self.conn.cursor()
-            cursor.execute("SELECT id, qty FROM book WHERE title = ? AND author = ?", (title, author))
-            # Fetch the first row/next row of data from the database
-            row = cursor.fetchone()
-            if row:
-                book_id, qty = row
-                print(f'{qty} amount of "{title}" by "{author}" is already on the system...')
-                add_more = input("Do you want to add 1 more to the quantity (yes/no)?:\n").strip().lower()
-                
-                if add_more == "yes":
-                    cursor.execute("UPDATE book SET qty = ? WHERE id = ?", (qty +1, book_id))
-                    print(f'One additional book added to the system for "{title}" by "{author}".')
-                else:
-                    print('Quantity remains unchanged.')
-            else:
-                # Give the user an option to update the quantity here for better user interface and efficiency
-                print(f'New book "{title}" by "{author}" about to be added to the system...')
-                add_quantity = input(f'Would you like to update the quantity for "{title}" by "{author}"? (yes/no)\n').strip().lower()
-                if add_quantity == "yes":
-                    updated_quantity = int(input(f'How many books of "{title}" by "{author}" would you like on the system?\n'))
-                    cursor.execute("INSERT INTO book (title, author, qty) VALUES (?, ?, ?)", (title, author, updated_quantity))
-                    print(f'{updated_quantity} books of "{title}" by "{author}" were added successfully.')
-                else:
-                    cursor.execute("INSERT INTO book (title, author, qty) VALUES (?, ?, ?)", (title, author, quantity))
-                    print(f'New book "{title}" by "{author}" added successfully.')
-                
-                
-            self.conn.commit()
+            books = {book[0]: book for book in self.fetch_books_by_id([key[-1] for key in keys])}
         except sqlite3.Error as e:
-            print(f'Error adding a book to the database: {e}')
-            self.rollback() # Revert changes made if error found
+            raise DatabaseError(f'Problm occured searching for a book: {e}') from e
+        for key in keys:
+            book = books.get(key[-1])
+            if book is not None:
+                yield Book(*book), -key[0]
 
-    def update_book(self, title, author, quantity):
+    def fetch_books_by_id(self, book_ids):
         """
-        Update the quantity of a specific book with inserted title and author. Only need to update the quanitity as there is a menu option to delete a book.
-        If the quantity is set to 0 then the book is removed from the database.
-        If the book doesnt exist then notify the user and list all the books avaliable by the same author. The user can manually see if the book is on the system if its not correctly inputted. Give the option to update
+        Fetch full book rows for a collection of book IDs.
         
-        Arguements include the title (string), author (string) and quantity (int).
+        Returns a list of (id, title, author, qty) tuples in no particular order.
         """
-        try:
-            title = title.upper()
-            author = author.upper()
-            
-            cursor = self.conn.cursor()
-            cursor.execute("SELECT id, qty FROM book WHERE title = ? AND author = ?", (title, author))
-            row = cursor.fetchone()
-            if row:
-                book_id, old_qty = row
-                print(f'{old_qty} book(s) of "{title}" by "{author}" is currently on the system.')
-                
-                if quantity == 0:
-                    cursor.execute("DELETE FROM book WHERE id = ?", (book_id,))
-                    print(f'"{title}" by "{author}" removed from the database')
-                else:
-                    cursor.execute("UPDATE book SET qty = ? WHERE id = ?", (quantity, book_id))
-                    print(f'Quantity for "{title}" by "{author}" updated to {quantity}.')
-            else:
-                print(f'No book with the title "{title}" by "{author}" found in the database.')
-            self.conn.commit()
-        except sqlite3.Error as e:
-            print("Problem occured while trying to update a book: {e}")
-            self.rollback()
+        if self.snapshot is not None:
+            with self.index_lock:
+                books = [book for book in map(self.snapshot.get, book_ids) if book is not None]
+        else:
+            with self.reading() as conn:
+                books = list(select_in(conn, "SELECT id, title, author, qty FROM book WHERE id IN ({placeholders})", list(book_ids)))
+        self.count(rows_scanned=len(books))
+        return books
 
-    def delete_book(self, title=None, author=None, book_id=None):
+    @instrumented
+    def load_indexes(self):
         """
-        Delete a book from the database. If it doesnt exist then list all the books from the same author and ask the user if they which title they
-        want to delete if any, else print that no books were deleted then return user to menu
+        Build the title and author fuzzy indexes from the book table if they have not been built yet.
         
-        Takes on arguememts:
-            title (string) and author (string) of the book
-            book_id (int) is the books unique ID number that can be shown when searching for a book
+        Returns the (title index, author index) pair, both read under index_lock so they are from the same build.
         """
-        try:
-            cursor = self.conn.cursor()
-            # Deleting by book's unique ID
-            if book_id:
-                cursor.execute("SELECT title, author FROM book WHERE id = ?", (book_id,))
-                row = cursor.fetchone()
-                if row:
-                    title, author = row
-                    confirm = input(f'Are you sure you want to delete book "{title}" by "{author}" from the system? (yes/no): ').strip().lower()
-                    if confirm == "yes":
-                        cursor.execute("DELETE FROM book WHERE id = ?", (book_id,))
-                        print(f'Book "{title}" by "{author}" deleted from the system.')
-                        self.conn.commit()
-                    else:
-                        print("Operation canceled... Returning to menu.")
-                else:
-                    print(f'No book with ID {book_id} found in the database.')
-            
+        with self.index_lock:
+            if self.title_index is not None:
+                return self.title_index, self.author_index
+        # Writes wait for the build to finish before updating the indexes, so none are missed.
+        # The connection is taken before the index lock, the same order as writes take them in.
+        with self.reading() as conn, self.index_lock:
+            if self.title_index is not None:
+                return self.title_index, self.author_index
+            title_index = FuzzyIndex()
+            author_index = AuthorIndex(self.snapshot)
+            if self.snapshot is not None:
+                # Up to date with the same change_seq as the snapshot
+                rows = self.snapshot.rows()
             else:
-            # Deleting by books title AND author
-                title = title.upper()
-                author = author.upper()
-                
-                cursor.execute("SELECT id FROM book WHERE title = ? AND author = ?", (title, author))
-                row = cursor.fetchone()
-                if row:
-                    book_id = row[0]
-                    cursor.execute("DELETE FROM book WHERE id = ?", (book_id,))
-                    print(f'"{title}" by "{author}" removed from the database.')
-                else:
-                    print(f'No book with the title "{title}" by "{author} found in the database.')
-                self.conn.commit()
+                # Read before the books, rows of the log written in between are applied again by catch_up
+                self.change_seq = self.last_change(conn)
+                rows = conn.execute("SELECT id, title, author FROM book")
+            scanned = 0
+            for book_id, title, author in rows:
+                title_index.add(title.upper(), book_id)
+                author_index.add_author(author, title, book_id)
+                scanned += 1
+            self.count(rows_scanned=scanned)
+            self.title_index = title_index
+            self.author_index = author_index
+            return title_index, author_index
+
+    @instrumented
+    def load_snapshot(self):
+        """
+        (Re)load the in-memory CatalogueSnapshot from the book table.
+        """
+        snapshot = CatalogueSnapshot()
+        try:
+            # Taken in the same order as writes, which wait for the load so none are missed
+            with self.reading() as conn, self.index_lock:
+                change_seq = self.last_change(conn)
+                for book_id, title, author, qty in conn.execute("SELECT id, title, author, qty FROM book"):
+                    snapshot.add(book_id, title, author, qty)
+                self.snapshot = snapshot
+                # The indexes are up to date with an older change_seq, so they are rebuilt from the new snapshot
+                self.change_seq = change_seq
+                self.title_index = None
+                self.author_index = None
+            self.count(rows_scanned=len(snapshot))
         except sqlite3.Error as e:
-            print(f'Problem occured while trying to delete a book: {e}')
-            self.rollback()
+            raise DatabaseError(f'Problem occured while loading the books into memory: {e}') from e
 
-    def search_books(self, query, search_by_title=True, threshold=0.75):
+    def snapshot_memory(self):
         """
-        Search books by title or author utilizing a matching search algorithm to find books with similar titles or authors, every search is converted to upper case
-        since that is the format of the database. 
-        Multiple instances of a book title may occur. List the books with the title searched and arrange them by author (alphabetically).
-        If searched by author, list all the books by the author in alphabetical order.
+        Return the SnapshotMemory of the in-memory snapshot, or None if there isnt one.
+        The fuzzy indexes searches run on are measured separately by index_memory().
+        """
+        with self.index_lock:
+            return self.snapshot.memory_usage() if self.snapshot is not None else None
+
+    def index_memory(self):
+        """
+        Return the IndexMemory of the title and author fuzzy indexes, or None if they have not been built
+        (they are built by the first search, and never with the "fts" engine). With a snapshot the author
+        index reads authors and titles from it, so they are only counted in snapshot_memory().
+        """
+        with self.index_lock:
+            if self.title_index is None:
+                return None
+            books = sum(len(book_ids) for book_ids in self.title_index.ids.values())
+            title_bytes = self.title_index.memory_usage()
+            author_bytes = self.author_index.memory_usage()
+            total = title_bytes + author_bytes
+            return IndexMemory(books, title_bytes, author_bytes, total, total / books if books else 0.0)
+
+    def index_book(self, book_id, title, author, qty):
+        """
+        Add a newly written book to the fuzzy indexes (if they have been built) and the snapshot (if there is one).
+        """
+        with self.index_lock:
+            if self.title_index is not None:
+                self.title_index.add(title.upper(), book_id)
+                self.author_index.add_author(author, title, book_id)
+            if self.snapshot is not None:
+                self.snapshot.add(book_id, title, author, qty)
+
+    def index_quantity(self, book_id, qty):
+        """
+        Record a changed quantity in the snapshot (if there is one and it has the book). A book added by another
+        connection may not be in it yet, catch_up adds it with the quantity it ends up with.
+        """
+        with self.index_lock:
+            if self.snapshot is not None and book_id in self.snapshot.positions:
+                self.snapshot.set_quantity(book_id, qty)
+
+    def unindex_book(self, book_id, title, author):
+        """
+        Remove a deleted book from the fuzzy indexes (if they have been built) and the snapshot (if there is one).
+        """
+        with self.index_lock:
+            if self.title_index is not None:
+                self.title_index.remove(title.upper(), book_id)
+                self.author_index.remove_author(author, book_id)
+            if self.snapshot is not None:
+                self.snapshot.remove(book_id)
         
-        Handle mispelt/human error by adding a percentage error check for similar spelt titles or similar spelt books.
+    @instrumented
+    def import_books(self, rows, batch_size=50000, progress=None):
+        """
+        Bulk import books from an iterable of (title, author, qty) rows, such as read_books().
+        Rows are read lazily and written a batch at a time with executemany, one transaction per batch.
+        A book that is already on the system (same title and author) has the imported quantity added to it,
+        as does a title and author repeated within the import.
         
-        Takes on arguements:
-            query (string) which is the search query of title or author
-            search_by_title (boolean statement). If its True, search by title. If not, search by author.
-            threshold (float) 0-1 threshold to consider a similar matching title. 
-            
-        Searching by title:
-        - First the code retrieves books from the database to find exact matches with the title
-        - It calculates a 'matching score' for each book title
-        - If there are no exact matches, similar titles are then recommended to the user (incase for spelling errors)
-        - The code will sort it out with highest match first
+        Arguments:
+            rows (iterable) of (title, author, qty) tuples.
+            batch_size (int) is the number of rows written per transaction.
+            progress (callable) is called after every batch with the rows imported so far and the seconds elapsed.
         
-        Searching by author:
-        - All books are retrieved by matching author
-        - If no match then the same check is done where suggestions are made that are above a match threshold (0.75 ~ 75%)
-        - Books are printed out alphabetically       
+        Returns an ImportResult. If a row is invalid InvalidBookError is raised before its batch is written,
+        if SQLite fails the batch is reverted and DatabaseError raised. Batches already imported stay in the database.
+        Raises InvalidSettingError for a batch_size below 1.
         """
+        if batch_size < 1:
+            raise InvalidSettingError(f'Books are imported at least 1 at a time, got a batch size of {batch_size}.')
+        started = time.perf_counter()
+        imported = inserted = merged = 0
         try:
-            query = query.upper()
-            cursor = self.conn.cursor()
-            
-            if search_by_title:
-                # Exact title match
-                cursor.execute("SELECT id, title, author, qty FROM book")
-                found_books = cursor.fetchall()
-                
-                found_books_with_threshold = []
-                
-                # Calculation for matching score for each book title with the search query
-                for book in found_books:
-                    title = book[1].upper()
-                    # Using Levenshtein Distance to calculate a matching score
-                    score = difflib.SequenceMatcher(None, query, title).ratio()
-                    if score >= threshold:
-                        found_books_with_threshold.append((book, score))
-                
-                if not found_books_with_threshold:
-                    # Suggestion for corrected title if no match and threshold critera is met
-                    corrected_title = self.suggested_corrected_title(query, [book[1] for book in found_books])
-                    if corrected_title:
-                        print(f'No books found. Did you mean: {corrected_title}?')
-                    else: 
-                        print("No books found.")
-                    input("Press Enter to return to menu.\n")
-                else:
-                    # Results are displayed and sorted
-                    # lambda function is the sorting key. List is sorted based on the index 1. Reverse = true is to sort  in descending order.
-                    found_books_with_threshold = sorted(found_books_with_threshold, key=lambda x: x[1], reverse=True)
-                    print("Similar search results:")
-                    # Display the results in a readable format
-                    print(f'{"ID":<8}{"Title":<55}{"Author":<30}{"Quantity":<8}')
-                    for book, score in found_books_with_threshold:
-                        print(f'{book[0]:<8}{book[1]:<55}{book[2]:<30}{book[3]:<8}')
-                    
-            else:
-                # Author search
-                cursor.execute("SELECT id, title, author, qty FROM book")
-                found_books = cursor.fetchall()
-                found_books_with_threshold = []
+            rows = iter(rows)
+            while True:
+                # Sum repeated books within the batch so each one is merged once
+                batch = {}
+                batch_rows = 0
+                for title, author, qty in rows:
+                    key = normalize_book(title, author)
+                    check_quantity(qty)
+                    batch[key] = batch.get(key, 0) + qty
+                    batch_rows += 1
+                    if batch_rows == batch_size:
+                        break
+                if not batch_rows:
+                    break
                 
-                for book in found_books:
-                    # Calculation for matching score for each author with the search query using Levenshtein score
-                    author = book[2].upper()
-                    score = difflib.SequenceMatcher(None, query, author).ratio()
-                    if score >= threshold:
-                        found_books_with_threshold.append((book, score))
+                # Only hold the write lock while the batch is written, not while the next one is read
+                with self.lock:
+                    try:
+                        cursor = self.conn.cursor()
+                        # New rows get IDs above the current highest, which is how inserts are told apart from merges
+                        last_id = cursor.execute("SELECT COALESCE(MAX(id), 0) FROM book").fetchone()[0]
+                        # Staged and then merged by a single statement: the search vocabulary triggers (when the
+                        # database has them) are much faster run by one statement than by one per row
+                        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS book_import (title TEXT, author TEXT, qty INTEGER)")
+                        cursor.execute("DELETE FROM book_import")
+                        cursor.executemany("INSERT INTO book_import (title, author, qty) VALUES (?, ?, ?)",
+                                           ((title, author, qty) for (title, author), qty in batch.items()))
+                        # WHERE true tells SQLite the ON CONFLICT belongs to the INSERT, not a join in the SELECT
+                        cursor.execute('''
+                            INSERT INTO book (title, author, qty) SELECT title, author, qty FROM book_import WHERE true ORDER BY rowid
+                            ON CONFLICT (title, author) DO UPDATE SET qty = qty + excluded.qty
+                        ''')
+                        batch_inserted = cursor.execute("SELECT COUNT(*) FROM book WHERE id > ?", (last_id,)).fetchone()[0]
+                        self.commit()
+                    except sqlite3.Error as e:
+                        self.rollback()
+                        raise DatabaseError(f'Problem occured while importing books: {e}') from e
+                    self.catalogue_changed()
+                inserted += batch_inserted
+                merged += len(batch) - batch_inserted
                 
-                if not found_books_with_threshold:
-                    # Suggestion for corrected authors if no match and threshold critera is met
-                    corrected_author = self.suggested_corrected_author(query, [book[2] for book in found_books])
-                    if corrected_author:
-                        print(f'No books found. Did you mean author: {corrected_author}?')
-                    else:
-                        print("No books found with that author.")
-                        input("Press Enter to return to menu.\n")
-                else:
-                    # Results are displayed and sorted
-                    found_books_with_threshold = sorted(found_books_with_threshold, key=lambda x: x[1], reverse=True)
-                    print("Similar search results:")
-                    print(f'{"ID":<8}{"Title":<55}{"Author":<30}{"Quantity":<8}')
-                    for book, score in found_books_with_threshold:
-                        print(f'{book[0]:<8}{book[1]:<55}{book[2]:<30}{book[3]:<8}')
+                imported += batch_rows
+                if progress:
+                    progress(imported, time.perf_counter() - started)
+        finally:
+            # Rebuilt rather than updated row by row
+            self.reload_indexes()
+        return ImportResult(imported, inserted, merged, time.perf_counter() - started)
+
+    def reload_indexes(self):
+        """
+        Throw away the fuzzy indexes, to be rebuilt on the next search, and reload the snapshot (if there is one)
+        after writes that did not update them, such as an import, a reverted transaction or writes by other
+        connections that have been trimmed from the change log.
+        """
+        with self.index_lock:
+            self.title_index = None
+            self.author_index = None
+        if self.snapshot is not None:
+            self.load_snapshot()
+        self.catalogue_changed()
+
+    @instrumented
+    def import_file(self, path, file_format=None, batch_size=50000, progress=None):
+        """
+        Bulk import a CSV or JSONL file, see read_books() for the layout and import_books() for the merging.
+        """
+        return self.import_books(read_books(path, file_format), batch_size=batch_size, progress=progress)
+
+    def iter_books(self, batch_size=10000, by_title=False):
+        """
+        Stream every book in ID order without loading the whole table, fetching batch_size rows at a time.
+        With by_title the books are in order of title and then author instead, read from the unique index.
+        
+        Yields Book records.
+        """
+        order = "title, author" if by_title else "id"
+        try:
+            with self.reading() as conn:
+                cursor = conn.execute(f"SELECT id, title, author, qty FROM book ORDER BY {order}")
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    self.count(rows_scanned=len(rows))
+                    for row in rows:
+                        yield Book(*row)
         except sqlite3.Error as e:
-            print(f'Problm occured searching for a book: {e}')
-            raise
+            raise DatabaseError(f'Problem occured while reading books: {e}') from e
+
+    @instrumented
+    def export_file(self, path, file_format=None):
+        """
+        Stream every book to a CSV or JSONL file (chosen by file_format or the file extension).
         
-    def suggested_corrected_title(self, query, titles):
+        Returns the number of books written.
+        """
+        return write_books(path, self.iter_books(), file_format)
+
+    @instrumented
+    def suggested_corrected_title(self, query, titles=None):
         """
         Find the best matching title in relation to the query for title.
         
         Arguements: 
         query (string) inputed by the user for a title and will be used to find a similar title
-        titles (list) is a list of titles to be compared to with the query
+        titles (list) is a list of titles to be compared to with the query. By default the titles shortlisted by
+        the search engine are used instead of going through every title.
         
         Returns None or a string with the best matches of the query
         """
-        try:
-            best_match = ""
-            best_score = 0
-            # Iterate through each title and calculate the score for a match
-            for title in titles:
-                score = difflib.SequenceMatcher(None, query, title).ratio()
-                
-                # Keep updating the best match if the score is higher
-                if score > best_score:
-                    best_match = title
-                    best_score = score
-            # Only return the match after the iteration if the score is greater than 0.75
-            return best_match if best_score >= 0.75 else None
-        except Exception as e:
-            print(f'Error suggestion corrected title: {e}')
-            raise
+        if titles is None:
+            self.check_other_writes()
+            query = query.upper()
+            titles = self.search_candidates(query, True, SUGGESTION_THRESHOLD, self.search_index(True))
+        titles = list(titles)
+        self.count(rows_scored=len(titles))
+        # The scorer keeps the first of the highest scores, in parallel for long lists
+        best = self.scorer.score(query, titles, math.inf).best
+        # Only return the match if the score is greater than 0.75
+        return titles[best[0]] if best and best[1] >= SUGGESTION_THRESHOLD else None
     
-    def suggested_corrected_author(self, query, authors):
+    @instrumented
+    def suggested_corrected_author(self, query, authors=None):
         """
         Find the closest match of authors with the query inputted by user with database.
         
         Arguements:
         query (string) inputed by the user for an author and will be used to find a similar author.
-        authors (list) is a list of authors from database to be compared to with the query.
+        authors (list) is a list of authors from database to be compared to with the query. By default the authors
+        shortlisted by the search engine are used instead of going through every author.
         
         Returns None or string with best matching author if above the threshold.
         """
-        try:
-            best_match = ""
-            best_score = 0
-            # Iterate through the authors then calculate matching score.
-            for author in authors:
-                score = difflib.SequenceMatcher(None, query, author).ratio()
-                
-                # Store the highest matching score of author
-                if score > best_score:
-                    best_match = author
-                    best_score = score
-                    
-            # Only return if the match bets the threshold
-            return best_match if best_score >= 0.75 else None
-        except Exception as e:
-            print(f'Problem occured while trying to suggest an author: {e}')
-            raise
+        if authors is None:
+            self.check_other_writes()
+            query = self.search_key(query, False)
+            index = self.search_index(False)
+            authors = self.search_candidates(query, False, SUGGESTION_THRESHOLD, index)
+            written = False
+        else:
+            authors = list(authors)
+            written = True
+        self.count(rows_scored=len(authors))
+        # Calculate the matching score of every author, keeping the highest
+        best = self.scorer.score(query, authors, math.inf).best
+        # Only return if the match bets the threshold
+        if not best or best[1] < SUGGESTION_THRESHOLD:
+            return None
+        return authors[best[0]] if written else self.display_value(False, authors[best[0]], index)
     
     def rollback(self):
         """
         Function to revert changes made when an error occurs. This maintains data consistency ensuring there isnt any invalid data added to the database
+        Inside a transaction() block this reverts the whole transaction, which then fails at its end.
+        
+        Raises DatabaseError if the changes could not be reverted.
         """
+        if self.transaction_depth:
+            self.transaction_reverted = True
         try:
             self.conn.rollback()
-            print("Changes to database have been reverted.")
         except sqlite3.Error as e:
-            print(f'Error trying to revert changes.')
+            raise DatabaseError(f'Error trying to revert changes: {e}') from e
             
     def close(self):
         """
-        Close the database connection.
+        Close the database connection, and the scorer if it was not given to BookDatabase.
         """
+        if self.owns_scorer:
+            self.scorer.close()
         try:
+            if self.pool is not None:
+                self.pool.close()
             self.conn.close()
         except sqlite3.Error as e:
-            print('Problem occured while trying to close the database: {e}')
+            raise DatabaseError(f'Problem occured while trying to close the database: {e}') from e
+
+
+class AsyncBookDatabase:
+    """
+    asyncio front end for BookDatabase, so the event loop is never blocked by it.
+    SQLite work runs on a dedicated thread pool, fuzzy scoring of large candidate lists runs on the FuzzyScorer's
+    process pool, and the number of requests in progress at once is limited.
+    
+    Use it with "async with AsyncBookDatabase(...) as db:" or call aclose() when finished.
+    """
+    def __init__(self, database_name, profile="concurrent", max_concurrency=64, scoring_processes=None,
+                 process_scoring_from=2000, **settings):
+        """
+        Arguments:
+            database_name, profile and settings are passed to BookDatabase. The "concurrent" profile gives searches
+            their own read connections so they are not held up by writes.
+            max_concurrency (int) is the most requests that can be in progress, others wait their turn.
+            scoring_processes (int) is the size of the scoring process pool, by default one per CPU.
+            process_scoring_from (int) is the number of candidates from which scoring is sent to the process pool,
+            smaller searches are scored on the SQLite thread because sending them costs more than scoring them.
+        """
+        # Calls arrive on the executor threads rather than the thread that opened the database
+        settings.setdefault("check_same_thread", False)
+        # Even a single scoring process keeps the CPU heavy scoring off the SQLite threads, so the pool is used
+        # from process_scoring_from candidates whatever the number of CPUs
+        self.scorer = FuzzyScorer(processes=scoring_processes, parallel_from=process_scoring_from)
+        self.db = BookDatabase(database_name, profile, scorer=self.scorer, **settings)
+        readers = len(self.db.pool.opened) if self.db.pool else 0
+        # Imported here, and kept for the methods below, so only programs that use this class pay for importing them
+        import asyncio
+        import concurrent.futures
+        self.asyncio = asyncio
+        # One thread per read connection plus one for the writer
+        self.sqlite_executor = concurrent.futures.ThreadPoolExecutor(max_workers=readers + 1, thread_name_prefix="bookstore-sqlite")
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.aclose()
+
+    async def run_sqlite(self, function, *args, **kwargs):
+        """
+        Run a BookDatabase method on the SQLite executor and wait for its result.
+        """
+        loop = self.asyncio.get_running_loop()
+        return await loop.run_in_executor(self.sqlite_executor, functools.partial(function, *args, **kwargs))
+
+    async def get_book(self, book_id):
+        """
+        Awaitable BookDatabase.get_book.
+        """
+        async with self.semaphore:
+            return await self.run_sqlite(self.db.get_book, book_id)
+
+    async def find_book(self, title, author):
+        """
+        Awaitable BookDatabase.find_book.
+        """
+        async with self.semaphore:
+            return await self.run_sqlite(self.db.find_book, title, author)
+
+    async def add_book(self, title, author, quantity=1):
+        """
+        Awaitable BookDatabase.add_book.
+        """
+        async with self.semaphore:
+            return await self.run_sqlite(self.db.add_book, title, author, quantity)
+
+    async def update_book(self, title, author, quantity):
+        """
+        Awaitable BookDatabase.update_book.
+        """
+        async with self.semaphore:
+            return await self.run_sqlite(self.db.update_book, title, author, quantity)
+
+    async def delete_book(self, title=None, author=None, book_id=None):
+        """
+        Awaitable BookDatabase.delete_book.
+        """
+        async with self.semaphore:
+            return await self.run_sqlite(self.db.delete_book, title=title, author=author, book_id=book_id)
+
+    async def apply_quantity_deltas(self, deltas):
+        """
+        Awaitable BookDatabase.apply_quantity_deltas.
+        """
+        async with self.semaphore:
+            return await self.run_sqlite(self.db.apply_quantity_deltas, list(deltas))
+
+    async def apply_operations(self, operations):
+        """
+        Awaitable BookDatabase.apply_operations.
+        """
+        async with self.semaphore:
+            return await self.run_sqlite(self.db.apply_operations, list(operations))
+
+    async def search_books(self, query, search_by_title=True, threshold=0.75):
+        """
+        Awaitable BookDatabase.search_books, giving the same results. Shortlisting and fetching the books run on the
+        SQLite executor and scoring on the process pool when there are enough candidates.
+        """
+        # Before the cache is read, as the check may make its entries stale
+        await self.run_sqlite(self.db.check_other_writes)
+        query = self.db.search_key(query, search_by_title)
+        key = (query, search_by_title, threshold)
+        generation, result = self.db.cached_search(key)
+        if result is not None:
+            return result
+        async with self.semaphore:
+            index = await self.run_sqlite(self.db.search_index, search_by_title)
+            candidates = await self.run_sqlite(self.db.search_candidates, query, search_by_title, threshold, index)
+            self.db.count(rows_scored=len(candidates))
+            with self.db.timed("search.scoring"):
+                if self.scorer.is_parallel(len(candidates)):
+                    futures = self.scorer.submit(query, candidates, threshold)
+                    scored = merge_scores(await self.asyncio.gather(*map(self.asyncio.wrap_future, futures)))
+                else:
+                    scored = await self.run_sqlite(score_chunk, query, candidates, threshold)
+            # Takes the index lock and scores sound-alikes, so it is kept off the event loop too
+            scored = await self.run_sqlite(self.db.with_sound_alikes, query, search_by_title, candidates, scored, index)
+            result = await self.run_sqlite(self.db.search_results, search_by_title, candidates, scored, index)
+        self.db.cache_search(key, generation, result)
+        return result
+
+    async def search_page(self, query, search_by_title=True, threshold=0.75, limit=20, offset=0, after=None):
+        """
+        Awaitable BookDatabase.search_page, run wholly on the SQLite executor.
+        """
+        async with self.semaphore:
+            return await self.run_sqlite(self.db.search_page, query, search_by_title, threshold, limit, offset, after)
+
+    async def aclose(self):
+        """
+        Wait for work in progress, shut down the executors and close the database.
+        """
+        loop = self.asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.sqlite_executor.shutdown)
+        await loop.run_in_executor(None, self.db.close)
+        await loop.run_in_executor(None, self.scorer.close)
+
+
+class ShardedCatalogue:
+    """
+    One catalogue over the databases of several stores (one ebookstore.db per branch), each opened as its own
+    BookDatabase. Searches and stock queries are sent to every store at once on a thread pool and their
+    results merged, writes go to the store named.
+    
+    The threads only overlap the stores' SQLite work. Their scoring is spread over cores by one FuzzyScorer shared
+    by every store, so there is one process pool however many stores there are.
+    
+    Use it with "with ShardedCatalogue(...) as catalogue:" or call close() when finished.
+    """
+    def __init__(self, stores, profile="concurrent", scoring_processes=None, process_scoring_from=2000, **settings):
+        """
+        Arguments:
+            stores (dict) maps store names to their database files, or is a list of database files
+            named after the file without its extension ("shops/leeds.db" is the store "leeds").
+            profile and settings are passed to every BookDatabase. The "concurrent" profile gives searches their
+            own read connections so they are not held up by writes.
+            scoring_processes (int) is the size of the shared scoring process pool, by default one per CPU.
+            process_scoring_from (int) is the number of candidates from which a store's scoring is sent to the
+            process pool, as AsyncBookDatabase.
+        
+        Raises InvalidSettingError for no stores or two stores with the same name, or the errors of BookDatabase.
+        """
+        if not isinstance(stores, dict):
+            paths = list(stores)
+            stores = {os.path.splitext(os.path.basename(path))[0]: path for path in paths}
+            if len(stores) != len(paths):
+                raise InvalidSettingError("Two stores have the same name, give the stores as a dictionary of names instead.")
+        if not stores:
+            raise InvalidSettingError("A catalogue needs at least one store.")
+        # A store is used by whichever fan-out thread is free
+        settings.setdefault("check_same_thread", False)
+        self.scorer = FuzzyScorer(processes=scoring_processes, parallel_from=process_scoring_from)
+        self.stores = {}
+        self.executor = None
+        try:
+            for name, database_name in stores.items():
+                self.stores[name] = BookDatabase(database_name, profile, scorer=self.scorer, **settings)
+        except BookstoreError:
+            self.close()
             raise
+        import concurrent.futures
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.stores), thread_name_prefix="bookstore-shard")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+    def store(self, name):
+        """
+        Return the BookDatabase of a store. Raises StoreNotFoundError for an unknown store.
+        """
+        try:
+            return self.stores[name]
+        except KeyError:
+            raise StoreNotFoundError(f'No store called "{name}" in the catalogue.') from None
+
+    def fan_out(self, calls):
+        """
+        Run calls, a dictionary of store names to functions taking no arguments, in parallel.
+        
+        Returns a dictionary of store names to results in the same order. If any call raises, the error of the
+        first of them is raised once every call has finished.
+        """
+        futures = {name: self.executor.submit(function) for name, function in calls.items()}
+        results = {}
+        error = None
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except BookstoreError as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return results
+
+    def search_books(self, query, search_by_title=True, threshold=0.75):
+        """
+        Search every store as BookDatabase.search_books.
+        
+        Returns a SearchResult of StoreMatch, the highest score first. Equal scores are in catalogue order of
+        the stores and then in each store's order. With no matches the suggestion is the one closest to the
+        query out of the stores' suggestions.
+        """
+        results = self.fan_out({name: functools.partial(db.search_books, query, search_by_title, threshold)
+                                for name, db in self.stores.items()})
+        # Each store's matches are already sorted, merging keeps equal scores in the order given
+        matches = list(heapq.merge(
+            *([StoreMatch(name, book, score) for book, score in result.matches] for name, result in results.items()),
+            key=lambda match: -match.score))
+        if matches:
+            return SearchResult(matches, None)
+        return SearchResult([], self.closest_suggestion(query, search_by_title, results))
+
+    def closest_suggestion(self, query, search_by_title, results):
+        """
+        Pick the suggestion closest to the query out of the SearchResults of the stores, scored as the stores
+        scored them. Returns None if no store made one.
+        """
+        best = None
+        best_score = 0
+        for name, result in results.items():
+            if result.suggestion is None:
+                continue
+            db = self.stores[name]
+            score = difflib.SequenceMatcher(None, db.search_key(query, search_by_title),
+                                            db.search_key(result.suggestion, search_by_title)).ratio()
+            if score > best_score:
+                best, best_score = result.suggestion, score
+        return best
+
+    def search_stock(self, query, search_by_title=True, threshold=0.75):
+        """
+        Search every store and total the stock of each matching title and author across the stores.
+        
+        Returns a SearchResult of (StockLevel, score) pairs, the highest score first, and the suggestion as search_books.
+        """
+        result = self.search_books(query, search_by_title, threshold)
+        levels = {}
+        scores = {}
+        for store, book, score in result.matches:
+            key = (book.title, book.author)
+            if key not in levels:
+                levels[key] = StockLevel(book.title, book.author, 0, {})
+                scores[key] = score
+            levels[key].stores[store] = book.qty
+        matches = [(level._replace(qty=sum(level.stores.values())), scores[key]) for key, level in levels.items()]
+        return SearchResult(matches, result.suggestion)
+
+    def find_stock(self, title, author):
+        """
+        Look up a book by its exact title and author (in any case) in every store.
+        
+        Returns its StockLevel. Raises BookNotFoundError if no store has it.
+        """
+        title, author = normalize_book(title, author)
+        books = self.fan_out({name: functools.partial(db.find_book, title, author) for name, db in self.stores.items()})
+        stores = {name: book.qty for name, book in books.items() if book is not None}
+        if not stores:
+            raise BookNotFoundError(f'"{title}" by "{author}" is not in any store.')
+        return StockLevel(title, author, sum(stores.values()), stores)
+
+    def iter_stock(self, batch_size=10000):
+        """
+        Stream the stock of every title and author in the catalogue, in order of title and then author.
+        The stores are read in that order from their unique indexes and merged as they are read, so memory does not
+        grow with the size of the catalogue.
+        
+        Yields StockLevel records.
+        """
+        def stock(position, db):
+            # Merged on title and author and then position, so a book's stores are in catalogue order
+            for book in db.iter_books(batch_size, by_title=True):
+                yield book.title, book.author, position, book.qty
+
+        names = list(self.stores)
+        level = None
+        for title, author, position, qty in heapq.merge(*(stock(position, db) for position, db in enumerate(self.stores.values()))):
+            if level is None or (level.title, level.author) != (title, author):
+                if level is not None:
+                    yield level
+                level = StockLevel(title, author, 0, {})
+            level = level._replace(qty=level.qty + qty)
+            level.stores[names[position]] = qty
+        if level is not None:
+            yield level
+
+    def add_book(self, store, title, author, quantity=1):
+        """
+        BookDatabase.add_book on the store named. Raises StoreNotFoundError for an unknown store.
+        """
+        return self.store(store).add_book(title, author, quantity)
+
+    def update_book(self, store, title, author, quantity):
+        """
+        BookDatabase.update_book on the store named. Raises StoreNotFoundError for an unknown store.
+        """
+        return self.store(store).update_book(title, author, quantity)
+
+    def delete_book(self, store, title=None, author=None, book_id=None):
+        """
+        BookDatabase.delete_book on the store named. Raises StoreNotFoundError for an unknown store.
+        """
+        return self.store(store).delete_book(title=title, author=author, book_id=book_id)
+
+    def apply_quantity_deltas(self, store, deltas):
+        """
+        BookDatabase.apply_quantity_deltas on the store named. Raises StoreNotFoundError for an unknown store.
+        """
+        return self.store(store).apply_quantity_deltas(deltas)
+
+    def apply_operations(self, operations):
+        """
+        Apply batches of writes to several stores in parallel, each as BookDatabase.apply_operations.
+        
+        Arguments:
+            operations (dict) maps store names to their list of operations.
+        
+        Returns a dictionary of store names to their list of results. Each store's batch is its own transaction:
+        if one fails only that store's batch is reverted and its error raised, the other stores keep their changes.
+        Raises StoreNotFoundError, before anything is written, for an unknown store.
+        """
+        return self.fan_out({name: functools.partial(self.store(name).apply_operations, batch)
+                             for name, batch in operations.items()})
+
+    def close(self):
+        """
+        Wait for work in progress, then close every store's database and the shared scoring process pool.
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+        error = None
+        for db in self.stores.values():
+            try:
+                db.close()
+            except DatabaseError as e:
+                error = error or e
+        self.scorer.close()
+        if error is not None:
+            raise error
+
+
+def print_books(books):
+    """
+    Display a list of Book records in a readable table.
+    """
+    print(f'{"ID":<8}{"Title":<55}{"Author":<30}{"Quantity":<8}')
+    for book in books:
+        print(f'{book.id:<8}{book.title:<55}{book.author:<30}{book.qty:<8}')
+
+
+def add_book_prompt(db, title, author):
+    """
+    Menu option 1. If the book is already on the system the user is asked if they want to add one more,
+    otherwise they have an option of choosing the quantity of the new book (default 1).
+    """
+    book = db.find_book(title, author)
+    if book:
+        print(f'{book.qty} amount of "{book.title}" by "{book.author}" is already on the system...')
+        add_more = input("Do you want to add 1 more to the quantity (yes/no)?:\n").strip().lower()
+        if add_more == "yes":
+            db.add_book(title, author)
+            print(f'One additional book added to the system for "{book.title}" by "{book.author}".')
+        else:
+            print('Quantity remains unchanged.')
+        return
+    
+    # Give the user an option to update the quantity here for better user interface and efficiency
+    title, author = normalize_book(title, author)
+    print(f'New book "{title}" by "{author}" about to be added to the system...')
+    add_quantity = input(f'Would you like to update the quantity for "{title}" by "{author}"? (yes/no)\n').strip().lower()
+    if add_quantity == "yes":
+        updated_quantity = int(input(f'How many books of "{title}" by "{author}" would you like on the system?\n'))
+        db.add_book(title, author, updated_quantity)
+        print(f'{updated_quantity} books of "{title}" by "{author}" were added successfully.')
+    else:
+        db.add_book(title, author)
+        print(f'New book "{title}" by "{author}" added successfully.')
+
+
+def update_book_prompt(db, title, author, quantity):
+    """
+    Menu option 2. Set the quantity of a book, a quantity of 0 removes it.
+    """
+    result = db.update_book(title, author, quantity)
+    book = result.book
+    print(f'{result.previous_qty} book(s) of "{book.title}" by "{book.author}" is currently on the system.')
+    if result.deleted:
+        print(f'"{book.title}" by "{book.author}" removed from the database')
+    else:
+        print(f'Quantity for "{book.title}" by "{book.author}" updated to {book.qty}.')
+
+
+def delete_book_prompt(db, title=None, author=None, book_id=None):
+    """
+    Menu option 3. Deleting by ID asks the user to confirm first.
+    """
+    if book_id is not None:
+        book = db.get_book(book_id)
+        confirm = input(f'Are you sure you want to delete book "{book.title}" by "{book.author}" from the system? (yes/no): ').strip().lower()
+        if confirm == "yes":
+            db.delete_book(book_id=book_id)
+            print(f'Book "{book.title}" by "{book.author}" deleted from the system.')
+        else:
+            print("Operation canceled... Returning to menu.")
+    else:
+        book = db.delete_book(title=title, author=author)
+        print(f'"{book.title}" by "{book.author}" removed from the database.')
+
+
+def search_books_prompt(db, query, search_by_title=True):
+    """
+    Menu option 4. Display the search results a page at a time, or the suggestion if nothing matched.
+    """
+    result = db.search_page(query, search_by_title=search_by_title, limit=SEARCH_PAGE_SIZE)
+    if result.matches:
+        print("Similar search results:")
+        while True:
+            with db.timed("search.output"):
+                print_books([book for book, score in result.matches])
+            if result.next_cursor is None:
+                break
+            more = input("Show more results (yes/no)?:\n").strip().lower()
+            if more != "yes":
+                break
+            result = db.search_page(query, search_by_title=search_by_title, limit=SEARCH_PAGE_SIZE, after=result.next_cursor)
+    elif search_by_title:
+        if result.suggestion:
+            print(f'No books found. Did you mean: {result.suggestion}?')
+        else:
+            print("No books found.")
+        input("Press Enter to return to menu.\n")
+    else:
+        if result.suggestion:
+            print(f'No books found. Did you mean author: {result.suggestion}?')
+        else:
+            print("No books found with that author.")
+            input("Press Enter to return to menu.\n")
+
+
+def import_books_prompt(db, path):
+    """
+    Menu option 5. Import a CSV or JSONL file, reporting progress and throughput as it goes.
+    """
+    def report(rows, seconds):
+        print(f'{rows} rows imported ({rows / max(seconds, 1e-9):,.0f} rows/s)...')
+    
+    result = db.import_file(path, progress=report)
+    print(f'Imported {result.rows} rows in {result.seconds:.2f}s: {result.inserted} new books, '
+          f'{result.merged} existing books had their quantity increased.')
+
+
+def export_books_prompt(db, path):
+    """
+    Menu option 6. Export every book to a CSV or JSONL file.
+    """
+    started = time.perf_counter()
+    written = db.export_file(path)
+    print(f'Exported {written} books to {path} in {time.perf_counter() - started:.2f}s.')
 
-def main():
+
+def main(argv=None):
     """
-    Populate the table that was requested in the task. Only insert data if the table 'book' is emptry to prevent re-entries.
+    Populate the table that was requested in the task. The pre-generated books are only inserted the first time the
+    program is run on a database to prevent re-entries.
+    
+    Run with --startup-time to print how long the program took to start, up to showing the menu.
 
     Main function of the program to display a menu of choice for the user to select from:
         - Enter a new book with details of book id, title, author and amount of books
         - Update an existing book in the database
         - Delete a book from the database
         - Search for a book by either title, author or unique ID
+        - Import books from, or export books to, a CSV or JSONL file
         - End the program 
     """
+    if argv is None:
+        argv = sys.argv[1:]
     try:
+        imported = time.perf_counter()
         db = BookDatabase("ebookstore.db")
+        opened = time.perf_counter()
 
         # Populate the table on start up of the program
-        db.populate_table()
+        try:
+            if db.populate_table():
+                print("Pre-generated books added successfully.")
+        except DatabaseError as e:
+            print(e)
+        seeded = time.perf_counter()
+
+        if "--startup-time" in argv:
+            print(f'Start up took {(seeded - STARTED) * 1000:.1f} ms: imports {(imported - STARTED) * 1000:.1f} ms, '
+                  f'opening the database {(opened - imported) * 1000:.1f} ms, '
+                  f'pre-generated books {(seeded - opened) * 1000:.1f} ms')
         
         # Menu Options
         while True:
@@ -412,44 +3048,60 @@ def main():
             print("2. Update book")
             print("3. Delete book")
             print("4. Search books")
+            print("5. Import books from file")
+            print("6. Export books to file")
             print("0. Exit")
 
             choice = input("\nEnter your choice: ")
 
-            if choice == "1":
-                title = input("Enter the book title: ")
-                author = input("Enter the author: ")
-                db.add_book(title, author)
-            elif choice == "2":
-                title = input("Enter the book title to update: ")
-                author = input("Enter the author of the book: ")
-                quantity = int(input("Enter the new quantity (Enter 0 to delete the book): "))
-                db.update_book(title, author, quantity)
-            elif choice == "3":
-                delete_option = input("Delete by Title/Author (T) or by books ID (I)?: ").strip().lower()
-                if delete_option == "t":                  
-                    title = input("Enter the book title to delete: ")
+            try:
+                if choice == "1":
+                    title = input("Enter the book title: ")
+                    author = input("Enter the author: ")
+                    add_book_prompt(db, title, author)
+                elif choice == "2":
+                    title = input("Enter the book title to update: ")
                     author = input("Enter the author of the book: ")
-                    db.delete_book(title=title, author=author)
-                elif delete_option == "i":
-                    book_id = int(input("Enter the book's ID you want to delete: "))
-                    db.delete_book(book_id=book_id)
-                else:
-                    print("Invalid Option. Input must be either 'T' or 'I'.")
-            elif choice == "4":
-                search_option = input("Search by Title (T) or Author (A): ").strip().lower()
-                query = input("Enter the search query: ")
-                if search_option == "t":
-                    db.search_books(query, search_by_title=True)
-                elif search_option == "a":
-                    db.search_books(query, search_by_title=False)
+                    quantity = int(input("Enter the new quantity (Enter 0 to delete the book): "))
+                    update_book_prompt(db, title, author, quantity)
+                elif choice == "3":
+                    delete_option = input("Delete by Title/Author (T) or by books ID (I)?: ").strip().lower()
+                    if delete_option == "t":                  
+                        title = input("Enter the book title to delete: ")
+                        author = input("Enter the author of the book: ")
+                        delete_book_prompt(db, title=title, author=author)
+                    elif delete_option == "i":
+                        book_id = int(input("Enter the book's ID you want to delete: "))
+                        delete_book_prompt(db, book_id=book_id)
+                    else:
+                        print("Invalid Option. Input must be either 'T' or 'I'.")
+                elif choice == "4":
+                    search_option = input("Search by Title (T) or Author (A): ").strip().lower()
+                    query = input("Enter the search query: ")
+                    if search_option == "t":
+                        search_books_prompt(db, query, search_by_title=True)
+                    elif search_option == "a":
+                        search_books_prompt(db, query, search_by_title=False)
+                    else:
+                        print("Invalid search option. Please enter 'T' for title or 'A' for author.")
+                elif choice == "5":
+                    import_books_prompt(db, input("Enter the CSV or JSONL file to import: ").strip())
+                elif choice == "6":
+                    export_books_prompt(db, input("Enter the CSV or JSONL file to export to: ").strip())
+                elif choice == "0":
+                    db.close()
+                    break
                 else:
-                    print("Invalid search option. Please enter 'T' for title or 'A' for author.")
-            elif choice == "0":
-                db.close()
-                break
-            else:
-                print("Invalid choice. Please enter a valid option.")
+                    print("Invalid choice. Please enter a valid option.")
+            except BookNotFoundError as e:
+                print(e)
+            except InvalidBookError as e:
+                print(f'Invalid book details: {e}')
+            except OSError as e:
+                print(f'Problem occured accessing the file: {e}')
+            except DatabaseError as e:
+                print(e)
+                print("Changes to database have been reverted.")
     except Exception as e:
         print(f'Unexpected error occured on the main program: {e}')
         
@@ -0,0 +1,345 @@
+# Benchmarks for the bookstore program. Run "python benchmark.py --help" for the options.
+import argparse
+import difflib
+import json
+import math
+import os
+import platform
+import random
+import sqlite3
+import tempfile
+import time
+
+import Bookstore
+
+# Words used to make up synthetic titles
+TITLE_WORDS = [
+    "THE", "A", "OF", "AND", "IN", "TALE", "TWO", "CITIES", "HOUSE", "NIGHT", "RIVER", "STONE", "FIRE", "WAR", "PEACE",
+    "GREAT", "LITTLE", "LOST", "SECRET", "GARDEN", "KING", "QUEEN", "SHADOW", "LIGHT", "WINTER", "SUMMER", "DARK",
+    "STAR", "OCEAN", "MOUNTAIN", "CHILDREN", "LAST", "FIRST", "GOLDEN", "SILVER", "ROAD", "CASTLE", "DREAM", "WIND",
+]
+
+
+# Parts used to make up synthetic author names
+FIRST_NAMES = [
+    "JAMES", "MARY", "JOHN", "PATRICIA", "ROBERT", "JENNIFER", "MICHAEL", "LINDA", "WILLIAM", "ELIZABETH", "DAVID",
+    "BARBARA", "RICHARD", "SUSAN", "JOSEPH", "JESSICA", "THOMAS", "SARAH", "CHARLES", "KAREN", "AGATHA", "LEO",
+]
+SURNAMES = [
+    "SMITH", "JOHNSON", "WILLIAMS", "BROWN", "JONES", "GARCIA", "MILLER", "DAVIS", "RODRIGUEZ", "MARTINEZ", "WILSON",
+    "ANDERSON", "TAYLOR", "THOMAS", "MOORE", "JACKSON", "MARTIN", "LEE", "THOMPSON", "WHITE", "HARRIS", "CLARK",
+    "LEWIS", "ROBINSON", "WALKER", "YOUNG", "ALLEN", "KING", "WRIGHT", "SCOTT", "HILL", "GREEN", "ADAMS", "BAKER",
+]
+
+
+def synthetic_titles(count, seed=0):
+    """
+    Make up count random titles of two to six words.
+    """
+    rng = random.Random(seed)
+    return [" ".join(rng.choices(TITLE_WORDS, k=rng.randint(2, 6))) for _ in range(count)]
+
+
+def misspell(text, rng):
+    """
+    Introduce one typing mistake (a dropped, doubled or swapped character) into a string.
+    """
+    position = rng.randrange(len(text) - 1)
+    mistake = rng.choice(("drop", "double", "swap"))
+    if mistake == "drop":
+        return text[:position] + text[position + 1:]
+    if mistake == "double":
+        return text[:position] + text[position] + text[position:]
+    return text[:position] + text[position + 1] + text[position] + text[position + 2:]
+
+
+def synthetic_catalogue(count, seed=0, books_per_author=20, duplicate_title_rate=0.1):
+    """
+    Stream count synthetic books as (title, author, qty) rows, shaped like a real catalogue:
+    - authors are shared, each writing about books_per_author books on average
+    - about duplicate_title_rate of the books reuse an earlier title under another author
+      (like "A TALE OF TWO CITIES" by Dickens and by Christie)
+    - a series number on some titles keeps most (title, author) pairs distinct
+    Rows are generated lazily so catalogues of millions of books need no memory.
+    """
+    rng = random.Random(seed)
+    author_count = max(1, count // books_per_author)
+    recent_titles = []
+    for number in range(count):
+        author_number = rng.randrange(author_count)
+        author = f"{FIRST_NAMES[author_number % len(FIRST_NAMES)]} {SURNAMES[author_number // len(FIRST_NAMES) % len(SURNAMES)]}"
+        if author_number >= len(FIRST_NAMES) * len(SURNAMES):
+            # Tell apart authors with the same name, as an initial would
+            author += f" {author_number // (len(FIRST_NAMES) * len(SURNAMES))}"
+        if recent_titles and rng.random() < duplicate_title_rate:
+            title = rng.choice(recent_titles)
+        else:
+            title = " ".join(rng.choices(TITLE_WORDS, k=rng.randint(2, 6)))
+            if rng.random() < 0.5:
+                title += f" {number}"
+            # A bounded pool of earlier titles to duplicate from
+            if len(recent_titles) < 10000:
+                recent_titles.append(title)
+            else:
+                recent_titles[rng.randrange(10000)] = title
+        yield title, author, rng.randint(1, 50)
+
+
+def percentiles(seconds):
+    """
+    Summarize a list of operation times as throughput and latency percentiles in milliseconds.
+    """
+    ordered = sorted(seconds)
+    count = len(ordered)
+
+    def percentile(fraction):
+        # Nearest rank: the smallest time with at least the fraction of the times at or below it
+        return ordered[max(0, math.ceil(fraction * count) - 1)] * 1000
+
+    total = sum(ordered)
+    return {
+        "operations": count,
+        "ops_per_second": count / total if total else None,
+        "mean_ms": total / count * 1000,
+        "p50_ms": percentile(0.50),
+        "p90_ms": percentile(0.90),
+        "p99_ms": percentile(0.99),
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def time_operations(operation, arguments):
+    """
+    Run operation once for each set of arguments and return the list of times taken in seconds.
+    """
+    seconds = []
+    for args in arguments:
+        started = time.perf_counter()
+        operation(*args)
+        seconds.append(time.perf_counter() - started)
+    return seconds
+
+
+def benchmark_suite(args):
+    """
+    Generate a synthetic catalogue, bulk load it and time every BookDatabase operation against it.
+    The report is JSON so runs of different versions can be compared.
+    """
+    rng = random.Random(args.seed)
+    directory = None
+    database = args.database
+    if database is None:
+        directory = tempfile.TemporaryDirectory()
+        database = os.path.join(directory.name, "benchmark.db")
+    elif os.path.exists(database):
+        raise SystemExit(f'{database} already exists, the benchmark needs a new database')
+
+    report = {
+        "benchmark": "suite",
+        "books": args.books,
+        "operations": args.operations,
+        "profile": args.profile,
+        "snapshot": args.snapshot,
+        "engine": args.engine,
+        "seed": args.seed,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "schema_version": Bookstore.SCHEMA_VERSION,
+        "cpus": os.cpu_count(),
+        "results": {},
+    }
+    results = report["results"]
+    try:
+        # Caching is off so every search does the full work
+        db = Bookstore.BookDatabase(database, args.profile, cache=False)
+        started = time.perf_counter()
+        imported = db.import_books(synthetic_catalogue(args.books, args.seed))
+        seconds = time.perf_counter() - started
+        results["bulk_load"] = {"rows": imported.rows, "seconds": seconds, "rows_per_second": imported.rows / seconds}
+        if args.snapshot:
+            db.close()
+            started = time.perf_counter()
+            db = Bookstore.BookDatabase(database, args.profile, cache=False, snapshot=True, search_engine=args.engine)
+            results["snapshot_load"] = {"seconds": time.perf_counter() - started, **db.snapshot_memory()._asdict()}
+        elif args.engine != "difflib":
+            db.close()
+            db = Bookstore.BookDatabase(database, args.profile, cache=False, search_engine=args.engine)
+
+        # The first search builds the fuzzy indexes, which is timed on its own
+        started = time.perf_counter()
+        db.search_books("")
+        results["index_build"] = {"seconds": time.perf_counter() - started}
+        index_memory = db.index_memory()
+        if index_memory is not None:
+            results["index_build"].update(index_memory._asdict())
+
+        # Sample real books to search for, update and delete
+        sample = list(db.iter_books())
+        sample = rng.sample(sample, min(len(sample), args.operations * 2))
+        searched = sample[:args.operations]
+        removed = sample[args.operations:]
+
+        searches = {
+            "search_title_hit": [(misspell(book.title, rng), True) for book in searched],
+            "search_title_miss": [(" ".join(rng.choices(SURNAMES, k=3)), True) for _ in searched],
+            "search_author_hit": [(misspell(book.author, rng), False) for book in searched],
+            "search_author_miss": [(" ".join(rng.choices(TITLE_WORDS, k=2)), False) for _ in searched],
+        }
+        for name, arguments in searches.items():
+            results[name] = percentiles(time_operations(db.search_books, arguments))
+
+        new_books = [(f"BENCHMARK TITLE {number}", "BENCHMARK AUTHOR", 1) for number in range(args.operations)]
+        results["add_book"] = percentiles(time_operations(db.add_book, new_books))
+        results["update_book"] = percentiles(time_operations(
+            db.update_book, [(book.title, book.author, book.qty + 1) for book in searched]))
+        results["delete_book"] = percentiles(time_operations(
+            lambda book_id: db.delete_book(book_id=book_id), [(book.id,) for book in removed]))
+        db.close()
+    finally:
+        if directory is not None:
+            directory.cleanup()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+def benchmark_shards(args):
+    """
+    Build one synthetic store database per store and time searching them all one after the other against
+    searching them through a ShardedCatalogue, checking that both find the same books.
+    """
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        paths = [os.path.join(directory, f"store{number}.db") for number in range(args.stores)]
+        titles = []
+        for number, path in enumerate(paths):
+            db = Bookstore.BookDatabase(path, cache=False)
+            db.import_books(synthetic_catalogue(args.books, args.seed + number))
+            titles.extend(book.title for book in db.iter_books())
+            db.close()
+        queries = [misspell(rng.choice(titles), rng) for _ in range(args.queries)]
+        print(f'Searching {args.stores} stores of {args.books} books for {args.queries} misspelt titles')
+
+        # Both ways share a scorer, as the catalogue's stores do, and build their indexes before timing
+        scorer = Bookstore.FuzzyScorer(parallel_from=2000)
+        stores = [Bookstore.BookDatabase(path, "concurrent", scorer=scorer, cache=False) for path in paths]
+        catalogue = Bookstore.ShardedCatalogue(paths, cache=False)
+        for db in stores:
+            db.search_books("")
+        catalogue.search_books("")
+
+        serial_seconds = sharded_seconds = 0
+        for query in queries:
+            started = time.perf_counter()
+            expected = [db.search_books(query).matches for db in stores]
+            serial_seconds += time.perf_counter() - started
+
+            started = time.perf_counter()
+            result = catalogue.search_books(query)
+            sharded_seconds += time.perf_counter() - started
+
+            found = sorted((match.store, match.book.id) for match in result.matches)
+            if found != sorted((f"store{number}", book.id) for number, matches in enumerate(expected) for book, score in matches):
+                raise SystemExit(f'Results differ for query "{query}"')
+        for db in stores:
+            db.close()
+        scorer.close()
+        catalogue.close()
+
+    print(f'{"serial":<10}{serial_seconds / args.queries * 1000:>10.1f} ms/query')
+    print(f'{"sharded":<10}{sharded_seconds / args.queries * 1000:>10.1f} ms/query')
+    print(f'Speedup {serial_seconds / sharded_seconds:.1f}x, results identical')
+
+
+def score_naively(query, titles, threshold):
+    """
+    Score titles the way search_books did before score_chunk: a new SequenceMatcher and a full ratio() for
+    every title, then a second pass over every title for the "Did you mean" suggestion when nothing matched.
+    """
+    matches = []
+    for position, title in enumerate(titles):
+        score = difflib.SequenceMatcher(None, query, title).ratio()
+        if score >= threshold:
+            matches.append((position, score))
+    best = None
+    if not matches:
+        best_score = 0
+        for position, title in enumerate(titles):
+            score = difflib.SequenceMatcher(None, query, title).ratio()
+            if score > best_score:
+                best = (position, score)
+                best_score = score
+        if best_score < Bookstore.SUGGESTION_THRESHOLD:
+            best = None
+    return matches, best
+
+
+def benchmark_scoring(args):
+    """
+    Compare score_chunk against naive scoring over the whole synthetic catalogue (no index shortlisting),
+    checking that both give exactly the same matches and suggestions.
+    """
+    rng = random.Random(args.seed)
+    titles = synthetic_titles(args.titles, args.seed)
+    queries = [misspell(rng.choice(titles), rng) for _ in range(args.queries)]
+    print(f'Scoring {args.queries} misspelt queries against {args.titles} titles, threshold {args.threshold}')
+
+    naive_seconds = tiered_seconds = 0
+    for query in queries:
+        started = time.perf_counter()
+        expected = score_naively(query, titles, args.threshold)
+        naive_seconds += time.perf_counter() - started
+
+        started = time.perf_counter()
+        result = Bookstore.score_chunk(query, titles, args.threshold)
+        tiered_seconds += time.perf_counter() - started
+
+        if result.matches != expected[0] or (not result.matches and result.best != expected[1]):
+            raise SystemExit(f'Results differ for query "{query}"')
+
+    print(f'{"naive":<10}{naive_seconds / args.queries * 1000:>10.1f} ms/query')
+    print(f'{"tiered":<10}{tiered_seconds / args.queries * 1000:>10.1f} ms/query')
+    print(f'Speedup {naive_seconds / tiered_seconds:.1f}x, results identical')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the bookstore program.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    scoring = subparsers.add_parser("scoring", help="tiered fuzzy scoring against naive difflib scoring")
+    scoring.add_argument("--titles", type=int, default=100000, help="number of synthetic titles (default 100000)")
+    scoring.add_argument("--queries", type=int, default=20, help="number of queries (default 20)")
+    scoring.add_argument("--threshold", type=float, default=0.75, help="match threshold (default 0.75)")
+    scoring.add_argument("--seed", type=int, default=0, help="random seed (default 0)")
+    scoring.set_defaults(run=benchmark_scoring)
+
+    suite = subparsers.add_parser("suite", help="bulk load a synthetic catalogue and time every operation, as JSON")
+    suite.add_argument("--books", type=int, default=10000,
+                       help="number of synthetic books, 10000 up to 10000000 (default 10000)")
+    suite.add_argument("--operations", type=int, default=200, help="operations timed of each kind (default 200)")
+    suite.add_argument("--profile", default="default", choices=sorted(Bookstore.CONNECTION_PROFILES),
+                       help="BookDatabase connection profile (default default)")
+    suite.add_argument("--snapshot", action="store_true", help="use the in-memory catalogue snapshot")
+    suite.add_argument("--engine", default="difflib", choices=Bookstore.SEARCH_ENGINES, help="search engine (default difflib)")
+    suite.add_argument("--database", help="new database file to build, by default a temporary one")
+    suite.add_argument("--output", help="write the JSON report to this file instead of printing it")
+    suite.add_argument("--seed", type=int, default=0, help="random seed (default 0)")
+    suite.set_defaults(run=benchmark_suite)
+
+    shards = subparsers.add_parser("shards", help="searching several store databases one by one against in parallel")
+    shards.add_argument("--stores", type=int, default=4, help="number of store databases (default 4)")
+    shards.add_argument("--books", type=int, default=50000, help="synthetic books in each store (default 50000)")
+    shards.add_argument("--queries", type=int, default=20, help="number of queries (default 20)")
+    shards.add_argument("--seed", type=int, default=0, help="random seed (default 0)")
+    shards.set_defaults(run=benchmark_shards)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
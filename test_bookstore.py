@@ -0,0 +1,598 @@
+# Tests for the bookstore program. Run with "python -m pytest".
+import difflib
+import random
+import sqlite3
+import threading
+
+import pytest
+
+import Bookstore
+from benchmark import misspell, percentiles, synthetic_catalogue
+
+
+@pytest.fixture
+def db(tmp_path):
+    """
+    A BookDatabase over a synthetic catalogue of 2000 books, without a search cache.
+    """
+    db = Bookstore.BookDatabase(str(tmp_path / "books.db"), cache=False)
+    db.import_books(synthetic_catalogue(2000, seed=1))
+    yield db
+    db.close()
+
+
+def scan_titles(db, query, threshold):
+    """
+    Search the titles the way the program did before the fuzzy index: score every book in the table.
+    """
+    query = query.upper()
+    matches = []
+    for book in db.iter_books():
+        score = difflib.SequenceMatcher(None, query, book.title).ratio()
+        if score >= threshold:
+            matches.append((-score, book.id))
+    return [(book_id, -score) for score, book_id in sorted(matches)]
+
+
+def scan_authors(db, query, threshold):
+    """
+    Search the authors by scoring the author key of every book in the table.
+    """
+    query = Bookstore.author_key(query)
+    matches = []
+    for book in db.iter_books():
+        key = Bookstore.author_key(book.author)
+        score = difflib.SequenceMatcher(None, query, key).ratio()
+        if score >= threshold:
+            matches.append((-score, key, book.title, book.id))
+    return [(match[-1], -match[0]) for match in sorted(matches)]
+
+
+@pytest.mark.parametrize("threshold", [0.5, 0.75, 0.9])
+def test_index_search_matches_full_scan(db, threshold):
+    titles = [book.title for book in db.iter_books()]
+    authors = [book.author for book in db.iter_books()]
+    for number in range(25):
+        query = misspell(titles[number * 37], random.Random(number))
+        result = db.search_books(query, threshold=threshold)
+        assert [(book.id, score) for book, score in result.matches] == scan_titles(db, query, threshold)
+        query = misspell(authors[number * 41], random.Random(number))
+        result = db.search_books(query, search_by_title=False, threshold=threshold)
+        assert [(book.id, score) for book, score in result.matches] == scan_authors(db, query, threshold)
+
+
+def test_writes_from_other_connections_are_seen(tmp_path):
+    path = str(tmp_path / "books.db")
+    writer = Bookstore.BookDatabase(path)
+    for settings in ({}, {"snapshot": True}):
+        reader = Bookstore.BookDatabase(path, **settings)
+        assert reader.search_books("Dune").matches == []
+        book = writer.add_book("Dune", "Frank Herbert", 3).book
+        assert [found for found, score in reader.search_books("Dune").matches] == [book]
+        assert reader.get_book(book.id) == book
+        writer.delete_book(book_id=book.id)
+        assert reader.search_books("Dune").matches == []
+        reader.close()
+    writer.close()
+
+
+@pytest.mark.parametrize("snapshot", [False, True])
+def test_writes_from_other_connections_are_caught_up(tmp_path, monkeypatch, snapshot):
+    # Keep a short log, so falling behind it is quick to test
+    monkeypatch.setattr(Bookstore, "CHANGE_LOG_ROWS", 1000)
+    path = str(tmp_path / "books.db")
+    writer = Bookstore.BookDatabase(path)
+    reader = Bookstore.BookDatabase(path, snapshot=snapshot, cache=False)
+    writer.import_books(synthetic_catalogue(500, seed=1))
+    queries = [(book.title, True) for book in writer.iter_books(batch_size=50)][::50]
+    queries += [(book.author, False) for book in writer.iter_books(batch_size=50)][::50]
+
+    def same_as_fresh_search():
+        fresh = Bookstore.BookDatabase(path, cache=False)
+        for query, search_by_title in queries:
+            assert reader.search_books(query, search_by_title) == fresh.search_books(query, search_by_title)
+        fresh.close()
+
+    same_as_fresh_search()
+    indexes = (reader.title_index, reader.author_index)
+    # Books added, changed and deleted by another connection are applied to the indexes built already
+    book = writer.add_book("Dune", "Frank Herbert", 3).book
+    first = next(writer.iter_books())
+    writer.update_book(first.title, first.author, 7)
+    writer.delete_book(book_id=first.id + 1)
+    same_as_fresh_search()
+    assert reader.get_book(book.id) == book
+    assert reader.get_book(first.id).qty == 7
+    assert reader.title_index is indexes[0] and reader.author_index is indexes[1]
+    # An import by another connection longer than the log is rebuilt from the table instead
+    writer.import_books(synthetic_catalogue(3000, seed=2))
+    same_as_fresh_search()
+    assert reader.title_index is not indexes[0]
+    reader.close()
+    writer.close()
+
+
+def test_invalid_titles(db):
+    with pytest.raises(Bookstore.InvalidBookError):
+        db.add_book(None, "Frank Herbert")
+    with pytest.raises(Bookstore.InvalidBookError):
+        db.delete_book()
+
+
+def test_json_quantities_must_be_whole_numbers(tmp_path):
+    path = tmp_path / "books.jsonl"
+    for qty in ("2.7", "true"):
+        path.write_text(f'{{"title": "Dune", "author": "Frank Herbert", "qty": {qty}}}\n')
+        with pytest.raises(Bookstore.InvalidBookError):
+            list(Bookstore.read_books(str(path)))
+
+
+def test_import_rejects_bad_batch_sizes(db):
+    for batch_size in (0, -1):
+        with pytest.raises(Bookstore.InvalidSettingError):
+            db.import_books([("Dune", "Frank Herbert", 1)], batch_size=batch_size)
+    assert db.find_book("Dune", "Frank Herbert") is None
+
+
+def create_baseline_database(path, rows):
+    """
+    Make a database the way the first version of the program did: the book table with no indexes or schema version.
+    """
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE book (id INTEGER PRIMARY KEY, title TEXT, author TEXT, qty INTEGER)")
+    conn.executemany("INSERT INTO book (id, title, author, qty) VALUES (?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+
+
+def test_migrate_baseline_database_merges_duplicates(tmp_path):
+    path = str(tmp_path / "ebookstore.db")
+    create_baseline_database(path, [
+        (1, "dune", "Frank Herbert", 2),
+        (2, "DUNE ", "FRANK HERBERT", 3),
+        (3, "Emma", "Jane Austen", 1),
+        (3001, "A Tale of Two Cities", "Charles Dickens", 30),
+    ])
+    db = Bookstore.BookDatabase(path)
+    assert db.schema_version() == Bookstore.SCHEMA_VERSION
+    assert list(db.iter_books()) == [
+        Bookstore.Book(1, "DUNE", "FRANK HERBERT", 5),
+        Bookstore.Book(3, "EMMA", "JANE AUSTEN", 1),
+        Bookstore.Book(3001, "A TALE OF TWO CITIES", "CHARLES DICKENS", 30),
+    ]
+    # The unique index now refuses duplicates, add_book adds to the existing book instead
+    assert db.add_book("Dune", "Frank Herbert", 1) == (Bookstore.Book(1, "DUNE", "FRANK HERBERT", 6), False)
+    db.close()
+
+
+def test_transaction_rollback(db):
+    with pytest.raises(ValueError):
+        with db.transaction():
+            db.add_book("Dune", "Frank Herbert", 5)
+            assert db.search_books("Dune").matches
+            raise ValueError
+    assert db.find_book("Dune", "Frank Herbert") is None
+    assert db.search_books("Dune").matches == []
+
+
+def test_apply_operations_rollback(db):
+    book = next(db.iter_books())
+    with pytest.raises(Bookstore.BookNotFoundError):
+        db.apply_operations([
+            ("add", "Dune", "Frank Herbert", 5),
+            ("adjust", book.id, 3),
+            ("delete", 10 ** 9),
+        ])
+    assert db.find_book("Dune", "Frank Herbert") is None
+    assert db.get_book(book.id) == book
+    assert db.search_books("Dune").matches == []
+
+
+def test_malformed_operations_are_rejected(db):
+    book = next(db.iter_books())
+    for operation in (("add", "a"), ("adjust", [1], 2), ("delete",), ("adjust", book.id), ("move", book.id), (), "add"):
+        with pytest.raises(Bookstore.InvalidBookError):
+            db.apply_operations([("adjust", book.id, 1), operation])
+    with pytest.raises(Bookstore.InvalidBookError):
+        db.apply_quantity_deltas([([book.id], 1)])
+    assert db.get_book(book.id) == book
+
+
+def test_quantity_deltas_on_book_with_no_copies(db):
+    book = db.add_book("Dune", "Frank Herbert", 0).book
+    result = db.apply_quantity_deltas([(book.id, 2)])
+    assert result == [Bookstore.UpdateResult(book._replace(qty=2), 0, False)]
+    with pytest.raises(Bookstore.BookNotFoundError):
+        db.apply_quantity_deltas([(book.id, -2), (book.id, 1)])
+    with pytest.raises(Bookstore.InvalidBookError):
+        db.apply_quantity_deltas([(book.id,)])
+    assert db.get_book(book.id).qty == 2
+
+
+def test_search_page_cursor_continuity(db):
+    query, threshold = "THE GOLDEN GARDEN", 0.5
+    expected = db.search_books(query, threshold=threshold).matches
+    assert len(expected) > 30
+    pages = []
+    page = db.search_page(query, threshold=threshold, limit=7)
+    while True:
+        pages.extend(page.matches)
+        if page.next_cursor is None:
+            break
+        page = db.search_page(query, threshold=threshold, limit=7, after=page.next_cursor)
+    assert pages == expected
+
+    # Books added between pages do not make later pages repeat or skip the books that were there before
+    first = db.search_page(query, threshold=threshold, limit=7)
+    db.add_book("THE GOLDEN GARDEN", "NEW AUTHOR", 1)
+    rest = list(db.iter_search(query, threshold=threshold, after=first.next_cursor))
+    seen = [book.id for book, score in first.matches + rest]
+    assert len(seen) == len(set(seen))
+    assert {book.id for book, score in expected} <= set(seen)
+
+
+def test_search_page_rejects_bad_limits(db):
+    for limit, offset in ((0, 0), (5, -1)):
+        with pytest.raises(Bookstore.InvalidSettingError):
+            db.search_page("DUNE", limit=limit, offset=offset)
+
+
+def test_sound_alike_authors_stay_above_threshold(tmp_path):
+    db = Bookstore.BookDatabase(str(tmp_path / "books.db"))
+    db.add_book("Some Book", "John Sneed")
+    db.add_book("Other Book", "John Smith")
+    db.add_book("To Kill a Mockingbird", "Harper Lee")
+    result = db.search_books("Harper Le", search_by_title=False, threshold=0.99)
+    assert result.matches == []
+    assert result.suggestion == "HARPER LEE"
+    result = db.search_books("Jon Smythe", search_by_title=False)
+    assert [book.author for book, score in result.matches] == ["JOHN SMITH"]
+    db.close()
+
+
+def table_names(path):
+    """
+    Return the names of the tables, indexes and triggers in a database file.
+    """
+    conn = sqlite3.connect(path)
+    names = {name for name, in conn.execute("SELECT name FROM sqlite_master")}
+    conn.close()
+    return names
+
+
+def test_fts_engine(db, tmp_path):
+    path = str(tmp_path / "books.db")
+    # Only databases searched with the "fts" engine get the search vocabulary
+    assert "book_vocab" not in table_names(path)
+    fts = Bookstore.BookDatabase(path, search_engine="fts", cache=False)
+    assert {"book_vocab", "book_vocab_fts"} <= table_names(path)
+    titles = [book.title for book in db.iter_books()]
+    for number in range(10):
+        query = misspell(titles[number * 97], random.Random(number))
+        assert fts.search_books(query).matches == db.search_books(query).matches
+    # The vocabulary follows writes made with either engine
+    fts.add_book("Dune Messiah", "Frank Herbert", 1)
+    assert [book.title for book, score in fts.search_books("Dune Mesiah").matches] == ["DUNE MESSIAH"]
+    assert [book.title for book, score in fts.search_books("Frank Herbet", search_by_title=False).matches] == ["DUNE MESSIAH"]
+    db.delete_book("Dune Messiah", "Frank Herbert")
+    assert fts.search_books("Dune Mesiah").matches == []
+    fts.close()
+
+
+def test_add_book_tells_new_books_from_existing(tmp_path):
+    db = Bookstore.BookDatabase(str(tmp_path / "books.db"))
+    book, created = db.add_book("Dune", "Frank Herbert", 2)
+    assert created
+    # Added again straight after it was inserted, when the connection's last insert is this book
+    assert db.add_book("dune", "frank herbert", 3) == (book._replace(qty=5), False)
+    db.close()
+
+
+def test_old_sqlite_is_refused(tmp_path, monkeypatch):
+    monkeypatch.setattr(Bookstore.sqlite3, "sqlite_version_info", (3, 31, 1))
+    with pytest.raises(Bookstore.DatabaseError, match="3.35.0 or later"):
+        Bookstore.BookDatabase(str(tmp_path / "books.db"))
+
+
+def test_pre_generated_books_are_added_once(tmp_path):
+    path = str(tmp_path / "ebookstore.db")
+    create_baseline_database(path, [(1, "Emma", "Jane Austen", 1)])
+    db = Bookstore.BookDatabase(path)
+    assert db.populate_table() == len(Bookstore.PRE_GENERATED_BOOKS)
+    db.delete_book(book_id=3001)
+    db.close()
+    db = Bookstore.BookDatabase(path)
+    assert db.populate_table() == 0
+    with pytest.raises(Bookstore.BookNotFoundError):
+        db.get_book(3001)
+    db.close()
+
+    # The first version of the program had already added them
+    path = str(tmp_path / "first.db")
+    create_baseline_database(path, [(3001, "A Tale of Two Cities", "Charles Dickens", 30)])
+    db = Bookstore.BookDatabase(path)
+    assert db.populate_table() == 0
+    db.close()
+
+
+def test_benchmark_percentiles_use_the_nearest_rank():
+    summary = percentiles([milliseconds / 1000 for milliseconds in range(1, 51)])
+    assert (round(summary["p50_ms"]), round(summary["p90_ms"]), round(summary["p99_ms"])) == (25, 45, 50)
+
+
+def search_while(db, write, threads=3):
+    """
+    Run write() in this thread while other threads search db, title and author searches in turn.
+    
+    Returns the errors the searching threads raised.
+    """
+    errors = []
+    done = threading.Event()
+
+    def search():
+        queries = ["THE GOLDEN GARDEN", "Jon Smythe", "DUNE", "Harper Le"]
+        try:
+            while not done.is_set():
+                for number, query in enumerate(queries):
+                    db.search_books(query, search_by_title=number % 2 == 0, threshold=0.5)
+                    db.search_page(query, search_by_title=number % 2 == 0, threshold=0.5, limit=5)
+        except Exception as e:
+            errors.append(e)
+
+    searchers = [threading.Thread(target=search) for _ in range(threads)]
+    for thread in searchers:
+        thread.start()
+    try:
+        write()
+    finally:
+        done.set()
+        for thread in searchers:
+            thread.join()
+    return errors
+
+
+@pytest.mark.parametrize("snapshot", [False, True])
+def test_concurrent_searches_while_importing(tmp_path, snapshot):
+    db = Bookstore.BookDatabase(str(tmp_path / "books.db"), "concurrent", cache=False, snapshot=snapshot)
+    db.import_books(synthetic_catalogue(2000, seed=1))
+
+    def write():
+        for number in range(40):
+            db.import_books([(f"Imported Book {number}", "Some Author", 1)])
+        with pytest.raises(ValueError):
+            with db.transaction():
+                db.add_book("Dune", "Frank Herbert")
+                raise ValueError
+
+    assert search_while(db, write) == []
+    # Every import is in the indexes, the reverted book is not
+    assert len(db.search_books("Imported Book 7").matches) == 40
+    assert db.search_books("Dune").matches == []
+    db.close()
+
+
+def test_concurrent_searches_while_another_connection_writes(tmp_path):
+    path = str(tmp_path / "books.db")
+    db = Bookstore.BookDatabase(path, "concurrent", cache=False)
+    db.import_books(synthetic_catalogue(2000, seed=1))
+    writer = Bookstore.BookDatabase(path, "concurrent")
+
+    def write():
+        for number in range(40):
+            writer.add_book(f"Other Book {number}", "Other Author")
+
+    assert search_while(db, write) == []
+    assert len(db.search_books("Other Book 7").matches) == 40
+    writer.close()
+    db.close()
+
+
+def test_snapshot_author_index_reads_the_snapshot(tmp_path):
+    path = str(tmp_path / "books.db")
+    listed = Bookstore.BookDatabase(path, cache=False)
+    listed.import_books(synthetic_catalogue(500, seed=2))
+    snapshotted = Bookstore.BookDatabase(path, cache=False, snapshot=True)
+    assert listed.index_memory() is None
+    book = next(snapshotted.iter_books())
+    snapshotted.update_book(book.title, book.author, 0)
+    snapshotted.add_book("ZZ NEW TITLE", book.author, 2)
+    listed.check_other_writes()
+    for query in (book.author, misspell(book.author, random.Random(3))):
+        expected = scan_authors(listed, query, 0.75)
+        for db in (listed, snapshotted):
+            result = db.search_books(query, search_by_title=False)
+            assert [(match.id, score) for match, score in result.matches] == expected
+    assert snapshotted.author_index.listing is None
+    # The indexes are reported next to the snapshot, and without the listing the author index is smaller
+    listed_memory = listed.index_memory()
+    snapshot_memory = snapshotted.index_memory()
+    assert snapshot_memory.books == listed_memory.books == 500
+    assert snapshot_memory.total_bytes == snapshot_memory.title_bytes + snapshot_memory.author_bytes
+    assert snapshot_memory.author_bytes < listed_memory.author_bytes
+    assert snapshotted.snapshot_memory().books == 500
+    listed.close()
+    snapshotted.close()
+
+
+def test_async_database_matches_the_sync_one(tmp_path):
+    import asyncio
+    path = str(tmp_path / "books.db")
+    sync_db = Bookstore.BookDatabase(path, cache=False)
+    sync_db.import_books(synthetic_catalogue(1000, seed=4))
+    books = list(sync_db.iter_books())[:5]
+    queries = [(misspell(book.title, random.Random(book.id)), True) for book in books]
+    queries += [(misspell(book.author, random.Random(book.id)), False) for book in books]
+    expected = [sync_db.search_books(query, search_by_title) for query, search_by_title in queries]
+    assert all(result.matches for result in expected)
+    sync_db.close()
+
+    async def run():
+        # Scored on the process pool from the first candidate, and in the executor otherwise
+        async with Bookstore.AsyncBookDatabase(path, scoring_processes=1, process_scoring_from=1) as pooled, \
+                Bookstore.AsyncBookDatabase(path, process_scoring_from=10 ** 9) as serial:
+            for db in (pooled, serial):
+                results = await asyncio.gather(*(db.search_books(query, search_by_title) for query, search_by_title in queries))
+                assert results == expected
+            added = await pooled.add_book("ASYNC TITLE", "ASYNC AUTHOR", 3)
+            assert added.created
+            updated = await pooled.update_book("ASYNC TITLE", "ASYNC AUTHOR", 5)
+            assert updated.previous_qty == 3
+            # A write by the other database is seen by the next search
+            assert (await serial.search_books("ASYNC TITLE")).matches[0][0] == updated.book
+            assert await serial.get_book(added.book.id) == updated.book
+            with pytest.raises(Bookstore.BookNotFoundError):
+                await pooled.delete_book(book_id=10 ** 9)
+
+    asyncio.run(run())
+
+
+def test_parallel_scoring_matches_serial(db, tmp_path):
+    assert Bookstore.FuzzyScorer(processes=1).parallel_from == float("inf")
+    assert Bookstore.FuzzyScorer(processes=2).parallel_from == 20000
+    titles = sorted({book.title for book in db.iter_books()})
+    query = misspell(titles[10], random.Random(5))
+    serial = Bookstore.FuzzyScorer(processes=2, parallel_from=10 ** 9)
+    parallel = Bookstore.FuzzyScorer(processes=2, parallel_from=1, chunks_per_process=3)
+    try:
+        assert parallel.is_parallel(len(titles)) and not serial.is_parallel(len(titles))
+        for threshold in (0.5, 0.75):
+            assert parallel.score(query, titles, threshold) == serial.score(query, titles, threshold)
+        # No matches, so the best candidate is kept for a suggestion, the first of equal scores across chunks
+        scored = parallel.score(query, titles + titles, 0.999)
+        assert scored.best is not None and scored == serial.score(query, titles + titles, 0.999)
+        expected = db.search_books(query)
+        parallel_db = Bookstore.BookDatabase(str(tmp_path / "books.db"), scorer=parallel, cache=False)
+        assert parallel_db.search_books(query) == expected
+        parallel_db.close()
+    finally:
+        parallel.close()
+        serial.close()
+
+
+def test_search_cache(tmp_path, monkeypatch):
+    path = str(tmp_path / "books.db")
+    cache = Bookstore.SearchCache(max_entries=2, ttl=60)
+    db = Bookstore.BookDatabase(path, cache=cache)
+    db.import_books(synthetic_catalogue(200, seed=6))
+    book = next(db.iter_books())
+    first = db.search_books(book.title)
+    assert db.search_books(book.title.lower()) == first
+    assert cache.stats()[:2] == (1, 1)
+    # The cached list is a copy, changing a result does not change the cache
+    first.matches.clear()
+    assert db.search_books(book.title).matches
+
+    # A write makes the entry stale, so the new quantity is found
+    db.update_book(book.title, book.author, book.qty + 4)
+    assert db.search_books(book.title).matches[0][0].qty == book.qty + 4
+    assert cache.stats().stale == 1
+    # As does a write by another connection
+    other = Bookstore.BookDatabase(path, cache=False)
+    other.update_book(book.title, book.author, 1)
+    assert db.search_books(book.title).matches[0][0].qty == 1
+    assert cache.stats().stale == 2
+    other.close()
+
+    # Entries older than the ttl are not used
+    now = Bookstore.time.monotonic()
+    monkeypatch.setattr(Bookstore.time, "monotonic", lambda: now + 61)
+    db.search_books(book.title)
+    assert cache.stats().expired == 1
+
+    # Past max_entries the least recently used entry is evicted
+    db.search_books(book.author, search_by_title=False)
+    db.search_books(book.title)
+    db.search_books("ANOTHER QUERY")
+    stats = cache.stats()
+    assert (stats.evictions, stats.size) == (1, 2)
+    assert list(cache.entries) == [(book.title, True, 0.75), ("ANOTHER QUERY", True, 0.75)]
+    db.close()
+
+
+def test_instrumentation(tmp_path):
+    calls = []
+    statements = []
+    instrumentation = Bookstore.Instrumentation(hook=lambda name, seconds: calls.append(name),
+                                                sql_trace=statements.append, progress_every=100)
+    db = Bookstore.BookDatabase(str(tmp_path / "books.db"), cache=False, instrumentation=instrumentation)
+    db.import_books(synthetic_catalogue(300, seed=7))
+    instrumentation.reset()
+    calls.clear()
+    statements.clear()
+    book = next(db.iter_books())
+    db.search_books(book.title)
+    db.update_book(book.title, book.author, 2)
+    stats = db.stats()
+    for name in ("search_books", "load_indexes", "search.candidates", "search.scoring", "search.fetch", "update_book"):
+        assert stats.timers[name].calls == 1
+        assert 0 <= stats.timers[name].max_seconds <= stats.timers[name].seconds
+    # Building the indexes scans the table, the search scores at least the book searched for
+    assert stats.rows_scanned >= 300 and stats.rows_scored >= 1
+    assert stats.sql_statements == len(statements) > 0 and stats.progress_calls > 0
+    assert sorted(calls) == sorted(name for name, timer in stats.timers.items() for _ in range(timer.calls))
+    db.close()
+    uninstrumented = Bookstore.BookDatabase(":memory:")
+    assert uninstrumented.stats() is None
+    uninstrumented.close()
+
+
+def test_sharded_catalogue(tmp_path):
+    paths = [str(tmp_path / f"{name}.db") for name in ("leeds", "york")]
+    for seed, path in enumerate(paths):
+        store = Bookstore.BookDatabase(path, cache=False)
+        store.import_books(synthetic_catalogue(300, seed=seed))
+        store.add_book("SHARED TITLE", "SHARED AUTHOR", seed + 1)
+        store.close()
+    with pytest.raises(Bookstore.InvalidSettingError):
+        Bookstore.ShardedCatalogue([paths[0], paths[0]])
+    with Bookstore.ShardedCatalogue(paths, scoring_processes=1, process_scoring_from=1) as catalogue:
+        assert list(catalogue.stores) == ["leeds", "york"]
+        stock = catalogue.find_stock("shared title", "shared author")
+        assert (stock.qty, stock.stores) == (3, {"leeds": 1, "york": 2})
+        with pytest.raises(Bookstore.BookNotFoundError):
+            catalogue.find_stock("NO SUCH TITLE", "NO SUCH AUTHOR")
+
+        # The same matches as searching each store, merged by score
+        query = misspell(next(catalogue.store("york").iter_books()).title, random.Random(8))
+        expected = [(name, book, score) for name, db in catalogue.stores.items() for book, score in db.search_books(query).matches]
+        result = catalogue.search_books(query)
+        assert result.matches
+        assert sorted(result.matches, key=lambda match: (-match.score, match.store, match.book.id)) == \
+            sorted(expected, key=lambda match: (-match[2], match[0], match[1].id))
+        assert [match.score for match in result.matches] == sorted((match.score for match in result.matches), reverse=True)
+        assert catalogue.search_stock("SHARED TITLE").matches[0][0] == stock
+
+        levels = list(catalogue.iter_stock(batch_size=50))
+        assert [(level.title, level.author) for level in levels] == sorted({(level.title, level.author) for level in levels})
+        assert sum(level.qty for level in levels) == sum(book.qty for db in catalogue.stores.values() for book in db.iter_books())
+
+        # A failing store's batch is reverted, the other store keeps its changes
+        with pytest.raises(Bookstore.BookNotFoundError):
+            catalogue.apply_operations({"leeds": [("add", "NEW TITLE", "NEW AUTHOR", 1)],
+                                        "york": [("add", "NEW TITLE", "NEW AUTHOR", 1), ("delete", 10 ** 9)]})
+        assert catalogue.find_stock("NEW TITLE", "NEW AUTHOR").stores == {"leeds": 1}
+        with pytest.raises(Bookstore.StoreNotFoundError):
+            catalogue.apply_operations({"hull": []})
+        with pytest.raises(Bookstore.StoreNotFoundError):
+            catalogue.add_book("hull", "NEW TITLE", "NEW AUTHOR")
+
+
+def test_connection_profiles(tmp_path):
+    with pytest.raises(Bookstore.InvalidSettingError):
+        Bookstore.BookDatabase(str(tmp_path / "books.db"), "fastest")
+    with pytest.raises(Bookstore.InvalidSettingError):
+        Bookstore.BookDatabase(str(tmp_path / "books.db"), unknown_setting=1)
+    with pytest.raises(Bookstore.InvalidSettingError):
+        Bookstore.BookDatabase(str(tmp_path / "books.db"), journal_mode="WAL; DROP TABLE book")
+    db = Bookstore.BookDatabase(str(tmp_path / "books.db"), "concurrent", readers=2, busy_timeout=2000)
+    assert db.conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert db.conn.execute("PRAGMA busy_timeout").fetchone()[0] == 2000
+    # Reads use the pool's read-only connections, writes the main one
+    assert len(db.pool.opened) == 2
+    with db.reading() as conn:
+        assert conn in db.pool.opened
+        with pytest.raises(sqlite3.OperationalError):
+            conn.execute("DELETE FROM book")
+    db.add_book("POOLED TITLE", "POOLED AUTHOR")
+    assert db.find_book("POOLED TITLE", "POOLED AUTHOR").qty == 1
+    db.close()